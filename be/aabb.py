@@ -1,9 +1,86 @@
 import math
 
+import numpy as np
+
 def intersect(ax, ay, aw, ah, bx, by, bw, bh):
   # returns if two AABBs intersect
   return ax < bx + bw and ax + aw > bx and ay < by + bh and ay + ah > by
 
+def sweep(ax, ay, aw, ah, vx, vy, bx, by, bw, bh):
+  # aabb a moves by (vx, vy) over one step, b stays put. returns the fraction
+  # of the step at which they first intersect (0 if they already do), or None
+  # if they don't intersect anywhere along the way
+  if vx:
+    tx0 = (bx - ax - aw) / vx
+    tx1 = (bx + bw - ax) / vx
+    if tx0 > tx1:
+      tx0, tx1 = tx1, tx0
+  elif ax < bx + bw and ax + aw > bx:
+    tx0, tx1 = -math.inf, math.inf
+  else:
+    return None
+  if vy:
+    ty0 = (by - ay - ah) / vy
+    ty1 = (by + bh - ay) / vy
+    if ty0 > ty1:
+      ty0, ty1 = ty1, ty0
+  elif ay < by + bh and ay + ah > by:
+    ty0, ty1 = -math.inf, math.inf
+  else:
+    return None
+  # they intersect while both axes overlap
+  t0 = max(tx0, ty0)
+  t1 = min(tx1, ty1)
+  if t0 >= t1 or t0 >= 1 or t1 <= 0:
+    return None
+  return max(t0, 0.)
+
+def raycast(grid, ox, oy, dx, dy, max_dist=math.inf):
+  # walks the cells of grid along the ray from (ox, oy) in direction (dx, dy),
+  # where cell (x, y) is the unit box centred at (x, y) like world tiles.
+  # returns the distance (in multiples of (dx, dy)) at which the ray enters the
+  # first cell that is set in grid, and that cell. (max_dist, None) if there
+  # is none within max_dist
+  width, height = grid.shape
+  x = math.floor(ox + 0.5)
+  y = math.floor(oy + 0.5)
+  # distance to the next cell boundary on each axis, and between boundaries
+  if dx:
+    step_x = 1 if dx > 0 else -1
+    delta_x = abs(1. / dx)
+    next_x = (x + 0.5 * step_x - ox) / dx
+  else:
+    step_x, delta_x, next_x = 0, math.inf, math.inf
+  if dy:
+    step_y = 1 if dy > 0 else -1
+    delta_y = abs(1. / dy)
+    next_y = (y + 0.5 * step_y - oy) / dy
+  else:
+    step_y, delta_y, next_y = 0, math.inf, math.inf
+
+  t = 0.
+  while t <= max_dist:
+    if 0 <= x < width and 0 <= y < height:
+      if grid[x, y]:
+        return t, (x, y)
+    elif (
+        (x < 0 and step_x <= 0) or (x >= width and step_x >= 0)
+        or (y < 0 and step_y <= 0) or (y >= height and step_y >= 0)
+    ):
+      # outside the grid and never coming back
+      break
+    if next_x < next_y:
+      t = next_x
+      next_x += delta_x
+      x += step_x
+    elif next_y < math.inf:
+      t = next_y
+      next_y += delta_y
+      y += step_y
+    else:
+      # no direction
+      break
+  return max_dist, None
 
 def _fix_rounding_error(x):
   if abs(x) < 0.000001:
@@ -33,3 +110,48 @@ def collide_and_slide(
   else:
     return (0, math.copysign(yoverlap, ay-by))
 
+
+def slide_out(boxes, velocities, tiles, owners):
+  # collide_and_slide for many boxes and tiles at once. boxes is an (n, 4)
+  # array of box centres and half sizes (x, y, w, h), velocities (n, 2) their
+  # velocities, tiles an (m, 4) array of tile aabbs and owners[j] the box that
+  # hit tile j. returns the (n, 2) centres of the boxes after sliding
+  #
+  # same as sliding each box out of its tiles one by one, nearest tile first
+  # and starting from where the last one left it. that is done in rounds,
+  # round k slides every box out of its k-th nearest tile, so there are only
+  # as many rounds as tiles any one box hit
+  boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+  velocities = np.asarray(velocities, dtype=np.float64).reshape(-1, 2)
+  tiles = np.asarray(tiles, dtype=np.float64).reshape(-1, 4)
+  owners = np.asarray(owners, dtype=np.intp)
+  pos = boxes[:, :2].copy()
+  half = boxes[:, 2:]
+  if not len(owners):
+    return pos
+  # nearest first (by the distance between centres, before any sliding)
+  centres = tiles[:, :2] + tiles[:, 2:] / 2.
+  dist = abs(centres - pos[owners]).sum(axis=1)
+  order = np.lexsort((dist, owners))
+  owners = owners[order]
+  tiles = tiles[order]
+  # owners is sorted now, the rank of a tile is how far into its box's run it is
+  rank = np.arange(len(owners)) - np.searchsorted(owners, owners)
+  for k in range(rank.max() + 1):
+    sel = rank == k
+    i = owners[sel]
+    # the same arithmetic as collide_and_slide, on both axes at once
+    a = pos[i] - half[i]
+    a_size = 2 * half[i]
+    b = tiles[sel, :2]
+    b_size = tiles[sel, 2:]
+    overlap = (a_size + b_size) / 2. - abs((a + a_size / 2.) - (b + b_size / 2.))
+    with np.errstate(divide='ignore'):
+      t = abs(overlap / (velocities[i] + 0.000001))
+    push = np.copysign(overlap, a - b)
+    # only slide along the axis that would take longer to cross the overlap
+    on_x = t[:, 0] < t[:, 1]
+    push[on_x, 1] = 0.
+    push[~on_x, 0] = 0.
+    pos[i] += push
+  return pos
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+# headless benchmark of the simulation: scripted bots play a game with no
+# server or browsers involved, and the game runs a fixed number of ticks as
+# fast as it can. everything is seeded, so the same scenario and seed always
+# plays out the same way (the digest in the results checks that)
+#
+# usage: python bench.py [scenario ...] [--ticks N] [--seed N] [--json]
+
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+from easydict import EasyDict as edict
+
+import game as ge
+import keys as ks
+import snapshot
+import weapon
+
+# name -> scenario. weapon is the weapon every bot holds (None lets the bots
+# switch weapons), world is passed on to world.gen_dungeon
+SCENARIOS = {
+  'shotgun50': {
+    'players': 50,
+    'weapon': 'Shotgun',
+  },
+  'mixed100': {
+    'players': 100,
+    'weapon': None,
+  },
+  'horde': {
+    'players': 20,
+    'weapon': None,
+    'enemies': 300,
+  },
+  'dungeon400': {
+    'players': 20,
+    'weapon': None,
+    'world': {
+      'width': 400, 'height': 400, 'num_rooms': 400,
+      'min_room_size': 15, 'max_room_size': 30, 'max_corridor_length': 40,
+    },
+  },
+}
+
+MOVES = [
+  (), ('w',), ('a',), ('s',), ('d',),
+  ('w', 'a'), ('w', 'd'), ('s', 'a'), ('s', 'd'),
+]
+AIMS = [
+  ('arrowup',), ('arrowleft',), ('arrowdown',), ('arrowright',),
+  ('arrowup', 'arrowleft'), ('arrowup', 'arrowright'),
+  ('arrowdown', 'arrowleft'), ('arrowdown', 'arrowright'),
+]
+
+class Bot:
+  # presses keys roughly like a person would: holds a direction for a while,
+  # shoots in bursts, rolls now and then and sometimes switches weapons.
+  # snapshots are acknowledged ack_lag ticks late, like over a real connection
+
+  def __init__(self, game, player_id, rng, switch_weapons=True, ack_lag=6):
+    self.game = game
+    self.player_id = player_id
+    self.rng = rng
+    self.switch_weapons = switch_weapons
+    self.ack_lag = ack_lag
+    self.move = ()
+    self.move_ticks = 0
+    self.aim = ()
+    self.aim_ticks = 0
+
+  def tick(self):
+    rng = self.rng
+    if self.move_ticks <= 0:
+      self.move = rng.choice(MOVES)
+      self.move_ticks = rng.randint(20, 90)
+    self.move_ticks -= 1
+    if self.aim_ticks <= 0:
+      # alternate between shooting bursts and pauses
+      self.aim = rng.choice(AIMS) if not self.aim and rng.random() < 0.7 else ()
+      self.aim_ticks = rng.randint(10, 60)
+    self.aim_ticks -= 1
+
+    keys = ks.mask(self.move + self.aim)
+    if self.move and rng.random() < 0.02:
+      keys |= ks.SHIFT
+    if self.switch_weapons and rng.random() < 0.005:
+      # a weapon switch happens when space is released, so hold it one tick
+      keys |= ks.SPACE
+    self.game.update_player_keys(self.player_id, keys)
+    self.game.ack_snapshot(self.player_id, self.game.current_tick - self.ack_lag)
+
+def make_game(scenario, seed, config=None):
+  config = edict({
+    'tps': 60,
+    'profile': True,
+    'world': scenario.get('world', {}),
+    'enemies_per_level': scenario.get('enemies', 0),
+    'seed': seed,
+    **(config or {}),
+  })
+  game = ge.Game(config)
+  # weapon spread comes from the global rng, seed it so runs are repeatable.
+  # the server leaves it alone, spread there is not meant to be predictable
+  random.seed(seed)
+  rng = random.Random(seed)
+  bots = []
+  for player_id in range(scenario['players']):
+    game.output.add_client(player_id)
+    game.new_player(player_id)
+    bots.append(Bot(game, player_id, random.Random(rng.getrandbits(64)),
+      switch_weapons=scenario['weapon'] is None))
+  game.flush_entities_buffer()
+  if scenario['weapon'] is not None:
+    idx = [w.__name__ for w in weapon.weapons].index(scenario['weapon'])
+    for player in game.players.values():
+      player.cur_weapon_idx = idx
+      player.cur_weapon = player.weapons[idx]
+  return game, bots
+
+def digest(game):
+  # checksum of the final state, equal digests mean identical simulations
+  snap = snapshot.Snapshot.capture(game.current_tick, game.entities, game.bullets)
+  return '%08x' % zlib.crc32(snap.states.tobytes(), zlib.crc32(snap.ids.tobytes()))
+
+def run(name, ticks=600, warmup=60, seed=0, trace=False, config=None):
+  scenario = SCENARIOS[name]
+  t = time.perf_counter()
+  game, bots = make_game(scenario, seed, config)
+  setup = time.perf_counter() - t
+  dt = game.scheduler.dt
+
+  def play(n):
+    for _ in range(n):
+      for bot in bots:
+        bot.tick()
+      game.tick(dt)
+
+  play(warmup)
+  # only measure the ticks after the warmup
+  game.profiler = type(game.profiler)(True, window=ticks)
+  bytes_sent = game.output.bytes_queued
+  gc_before = [s['collections'] for s in gc.get_stats()]
+  if trace:
+    tracemalloc.start()
+  blocks = sys.getallocatedblocks()
+  t = time.perf_counter()
+  play(ticks)
+  elapsed = time.perf_counter() - t
+  blocks = sys.getallocatedblocks() - blocks
+  if trace:
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+  result = {
+    'scenario': name,
+    'seed': seed,
+    'ticks': ticks,
+    'setup_seconds': setup,
+    'seconds': elapsed,
+    'ticks_per_second': ticks / elapsed,
+    'phases': {
+      k: {
+        'mean_ms': 1e3 * h.sum / h.count,
+        'p50_ms': 1e3 * h.quantile(0.5),
+        'p99_ms': 1e3 * h.quantile(0.99),
+      }
+      for k, h in sorted(game.profiler.timings.items())
+    },
+    'entities': len(game.entities),
+    'bullets': len(game.bullets) if game.bullets is not None else 0,
+    'bullet_pool': game.bullet_pool.stats(),
+    'bytes_per_tick': (game.output.bytes_queued - bytes_sent) / ticks,
+    'gc_collections': [
+      s['collections'] - b for s, b in zip(gc.get_stats(), gc_before)
+    ],
+    'allocated_blocks': blocks,
+    'digest': digest(game),
+  }
+  if trace:
+    result['traced_peak_bytes'] = peak
+  return result
+
+def report(result):
+  print(
+    f"{result['scenario']} (seed {result['seed']}): "
+    f"{result['ticks_per_second']:.1f} ticks/s over {result['ticks']} ticks, "
+    f"setup {result['setup_seconds']:.2f}s, digest {result['digest']}"
+  )
+  print(f"  {'phase':<20}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+  for phase, p in result['phases'].items():
+    print(f"  {phase:<20}{p['mean_ms']:>10.3f}{p['p50_ms']:>10.3f}{p['p99_ms']:>10.3f}")
+  print(
+    f"  entities {result['entities']}, bullets {result['bullets']}, "
+    f"{result['bytes_per_tick']:.0f} bytes/tick"
+  )
+  pool = result['bullet_pool']
+  print(f"  bullet pool: {pool['hits']} hits, {pool['misses']} misses, {pool['free']} free")
+  line = (
+    f"  gc collections {result['gc_collections']}, "
+    f"allocated blocks {result['allocated_blocks']:+d}"
+  )
+  if 'traced_peak_bytes' in result:
+    line += f", traced peak {result['traced_peak_bytes'] / 2**20:.1f} MiB"
+  print(line)
+
+def main():
+  parser = argparse.ArgumentParser(description='headless simulation benchmark')
+  parser.add_argument('scenarios', nargs='*',
+    help='scenarios to run, any of %s (default: all)' % ', '.join(SCENARIOS))
+  parser.add_argument('--ticks', type=int, default=600, help='ticks to measure')
+  parser.add_argument('--warmup', type=int, default=60, help='ticks to run before measuring')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--tracemalloc', action='store_true',
+    help='also trace peak memory (slows everything down)')
+  parser.add_argument('--json', action='store_true', help='print results as json')
+  args = parser.parse_args()
+  for name in args.scenarios:
+    if name not in SCENARIOS:
+      parser.error(f'unknown scenario {name}')
+
+  results = []
+  for name in args.scenarios or list(SCENARIOS):
+    result = run(name, args.ticks, args.warmup, args.seed, args.tracemalloc)
+    results.append(result)
+    if not args.json:
+      report(result)
+  if args.json:
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+  main()
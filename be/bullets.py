@@ -0,0 +1,229 @@
+import numpy as np
+
+import aabb
+import entity
+
+class BulletStore:
+  # struct of arrays storage for ordinary bullets.
+  # bullets are by far the most common entity, so instead of ticking them one
+  # python object at a time they live in numpy columns and are integrated,
+  # aged and culled with a handful of array operations per tick.
+  # bullets with special behaviour (eg., lasers) stay entity.Bullet objects,
+  # recycled through a BulletPool
+
+  # column name, dtype
+  columns = [
+    ('id', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('px', np.float64), # position before the last move
+    ('py', np.float64),
+    ('w', np.float64),
+    ('h', np.float64),
+    ('dx', np.float64),
+    ('dy', np.float64),
+    ('mx', np.float64),
+    ('my', np.float64),
+    ('speed', np.float64),
+    ('lifespan', np.int32),
+    ('dmg', np.int32),
+    ('src', np.int64), # entity id of the shooter
+    ('sprite_id', np.int32),
+  ]
+
+  def __init__(self, capacity=256):
+    self.n = 0
+    # bullets destroyed by hitting an entity, culled at the start of next tick
+    self.destroyed = None
+    self.capacity = capacity
+    for name, dtype in self.columns:
+      setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+  def __len__(self):
+    return self.n
+
+  def clear(self):
+    self.n = 0
+    self.destroyed = None
+
+  def grow(self):
+    self.capacity *= 2
+    for name, dtype in self.columns:
+      col = np.zeros(self.capacity, dtype=dtype)
+      col[:self.n] = getattr(self, name)[:self.n]
+      setattr(self, name, col)
+
+  def spawn(
+      self, id, src_id, x, y, dir, momentum=(0, 0),
+      w=0.25, h=0.25, speed=25, lifespan=120, dmg=5, sprite_id=0,
+  ):
+    # defaults match entity.Bullet
+    if self.n == self.capacity:
+      self.grow()
+    i = self.n
+    self.id[i] = id
+    self.x[i] = self.px[i] = x
+    self.y[i] = self.py[i] = y
+    self.w[i] = w
+    self.h[i] = h
+    self.dx[i], self.dy[i] = dir
+    self.mx[i], self.my[i] = momentum
+    self.speed[i] = speed
+    self.lifespan[i] = lifespan
+    self.dmg[i] = dmg
+    self.src[i] = src_id
+    self.sprite_id[i] = sprite_id
+    self.n += 1
+
+  def cull(self, dead):
+    # remove all bullets where dead is set, keeping the rest packed at the front
+    n = self.n
+    if not dead.any():
+      return
+    keep = ~dead
+    k = int(keep.sum())
+    for name, _ in self.columns:
+      col = getattr(self, name)
+      col[:k] = col[:n][keep]
+    self.n = k
+
+  def tick(self, delta):
+    # same as entity.Bullet.tick: bullets that ran out of lifespan are removed,
+    # everything else ages by one tick and moves
+    n = self.n
+    if not n:
+      return
+    lifespan = self.lifespan[:n]
+    dead = lifespan == 0
+    if self.destroyed is not None:
+      dead[:len(self.destroyed)] |= self.destroyed
+      self.destroyed = None
+    lifespan[~dead] -= 1
+    self.cull(dead)
+    n = self.n
+    self.px[:n] = self.x[:n]
+    self.py[:n] = self.y[:n]
+    self.x[:n] += (self.speed[:n] * self.dx[:n] + self.mx[:n]) * delta
+    self.y[:n] += (self.speed[:n] * self.dy[:n] + self.my[:n]) * delta
+
+  def aabbs(self):
+    n = self.n
+    w = self.w[:n]
+    h = self.h[:n]
+    return self.x[:n] - w, self.y[:n] - h, 2 * w, 2 * h
+
+  def velocities(self):
+    # per second, same as in tick
+    n = self.n
+    return (
+      self.speed[:n] * self.dx[:n] + self.mx[:n],
+      self.speed[:n] * self.dy[:n] + self.my[:n],
+    )
+
+  def moves(self):
+    # how far every bullet moved in the last tick, and which of them moved
+    # further than their own size (those could have skipped over something)
+    n = self.n
+    vx = self.x[:n] - self.px[:n]
+    vy = self.y[:n] - self.py[:n]
+    fast = (np.abs(vx) > 2 * self.w[:n]) | (np.abs(vy) > 2 * self.h[:n])
+    return vx, vy, fast
+
+  def collide_tiles(self, world):
+    # bullets are destroyed by any wall they touch
+    if not self.n:
+      return
+    bx, by, bw, bh = self.aabbs()
+    hit = world.any_wall(bx, by, bw, bh)
+    # fast bullets are also destroyed by walls anywhere along their path
+    vx, vy, fast = self.moves()
+    for i in (fast & ~hit).nonzero()[0].tolist():
+      # the box at the start of the move, and the box around the whole move
+      x, y, w, h = bx[i] - vx[i], by[i] - vy[i], bw[i], bh[i]
+      for tile in world.intersect(
+          min(x, bx[i]), min(y, by[i]), w + abs(vx[i]), h + abs(vy[i]),
+      ):
+        if aabb.sweep(x, y, w, h, vx[i], vy[i], *tile) is not None:
+          hit[i] = True
+          break
+    self.cull(hit)
+
+  def collide_entities(self, entities):
+    # test every bullet against every entity object in one broadcast.
+    # like entity.Bullet, whose removal is buffered until the next tick, a
+    # bullet may hit several entities in the same tick and is still sent to
+    # the clients this tick
+    n = self.n
+    if not n or not entities:
+      return
+    entities = list(entities)
+    ex = np.array([e.aabb_x for e in entities])[:, None]
+    ey = np.array([e.aabb_y for e in entities])[:, None]
+    ew = np.array([e.aabb_w for e in entities])[:, None]
+    eh = np.array([e.aabb_h for e in entities])[:, None]
+    eid = np.array([e.id for e in entities])[:, None]
+    bx, by, bw, bh = self.aabbs()
+    # fast bullets are tested with the box around their whole move first
+    vx, vy, fast = self.moves()
+    sx = np.where(fast, np.minimum(bx, bx - vx), bx)
+    sy = np.where(fast, np.minimum(by, by - vy), by)
+    sw = np.where(fast, bw + np.abs(vx), bw)
+    sh = np.where(fast, bh + np.abs(vy), bh)
+    hits = (
+      (sx < ex + ew) & (sx + sw > ex) & (sy < ey + eh) & (sy + sh > ey)
+      & (self.src[:n] != eid)
+    )
+    if not hits.any():
+      return
+    dead = np.zeros(n, dtype=bool)
+    dmg = self.dmg[:n].tolist()
+    for ei, bi in zip(*(v.tolist() for v in hits.nonzero())):
+      e = entities[ei]
+      if fast[bi] and aabb.sweep(
+          bx[bi] - vx[bi], by[bi] - vy[bi], bw[bi], bh[bi], vx[bi], vy[bi],
+          e.aabb_x, e.aabb_y, e.aabb_w, e.aabb_h,
+      ) is None:
+        continue
+      if e.damage(dmg[bi]):
+        dead[bi] = True
+    self.destroyed = dead
+
+class BulletPool:
+  # free list of entity.Bullet objects. bullets removed from the game are
+  # handed back here and reused for the next shots, so firing doesn't allocate
+
+  def __init__(self, game, max_size=1024):
+    self.game = game
+    self.max_size = max_size
+    self.free = []
+    # counters
+    self.hits = 0 # bullets reused
+    self.misses = 0 # bullets allocated since the pool was empty
+    self.released = 0
+
+  def __len__(self):
+    return len(self.free)
+
+  def acquire(self, src, x, y, dir, momentum=(0, 0), **params):
+    # params are passed on to entity.Bullet.reset
+    if self.free:
+      self.hits += 1
+      bullet = self.free.pop()
+      bullet.reset(src, x, y, dir, momentum, **params)
+      return bullet
+    self.misses += 1
+    return entity.Bullet(self.game, src, x, y, dir, momentum, **params)
+
+  def release(self, bullet):
+    # the bullet must not be in the game any more
+    self.released += 1
+    if len(self.free) < self.max_size:
+      self.free.append(bullet)
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'released': self.released,
+      'free': len(self.free),
+    }
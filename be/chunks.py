@@ -0,0 +1,90 @@
+import struct
+
+import numpy as np
+
+# the world map is streamed to the clients in square chunks of tiles, as each
+# player gets close to them (decoded by applyChunks in fe/app.js, keep the two
+# in sync). clients keep every chunk they get, so a chunk is only ever sent
+# once to each client
+#
+# a message is any number of chunks back to back, each
+#   header: u16 world width, u16 world height, u16 x, u16 y, u16 width,
+#           u16 height (x, y is the first tile of the chunk, width, height
+#           its size in tiles)
+#   body:   width * height u8 sprite ids, column by column (ie., indexed
+#           [x][y] like the world array)
+# all little endian
+
+HEADER = struct.Struct('<HHHHHH')
+
+# sprite id of the tiles a client has no chunk for yet
+UNKNOWN = 255
+
+class ChunkStreamer:
+  # keeps which chunks every viewer was sent and picks the ones to send them
+  # next, nearest first. every chunk is only encoded once
+
+  def __init__(self, world, chunk_size=16, radius=24., max_per_send=16):
+    grid = world.render_grid
+    if grid.min() < 0 or grid.max() >= UNKNOWN:
+      raise ValueError('sprite ids must fit in a byte')
+    self.grid = grid
+    self.width, self.height = grid.shape
+    self.chunk_size = chunk_size
+    # viewers are sent every chunk within this many tiles of them
+    self.radius = radius
+    # most chunks sent in one message, so teleports don't cause bursts
+    self.max_per_send = max_per_send
+    self.sent = {} # viewer -> chunks sent to the viewer
+    self.last = {} # viewer -> bounds when the viewer last had every chunk in range
+    self.cache = {} # chunk -> encoded chunk
+
+  def forget(self, viewer):
+    self.sent.pop(viewer, None)
+    self.last.pop(viewer, None)
+
+  def chunk(self, cx, cy):
+    buf = self.cache.get((cx, cy))
+    if buf is None:
+      s = self.chunk_size
+      tiles = self.grid[cx * s:(cx + 1) * s, cy * s:(cy + 1) * s]
+      w, h = tiles.shape
+      buf = self.cache[(cx, cy)] = (
+        HEADER.pack(self.width, self.height, cx * s, cy * s, w, h)
+        + tiles.astype(np.uint8).tobytes()
+      )
+    return buf
+
+  def bounds(self, x, y):
+    # inclusive range of chunks with tiles within radius of x, y (on both axes)
+    s = self.chunk_size
+    r = self.radius
+    return (
+      max(int((x - r) // s), 0),
+      max(int((y - r) // s), 0),
+      min(int((x + r) // s), (self.width - 1) // s),
+      min(int((y + r) // s), (self.height - 1) // s),
+    )
+
+  def encode(self, viewer, x, y):
+    # the chunks near x, y the viewer wasn't sent yet as one message (nearest
+    # first), or None if it has them all
+    bounds = self.bounds(x, y)
+    if self.last.get(viewer) == bounds:
+      # same chunks in range as when the viewer last got all of them
+      return None
+    cx0, cy0, cx1, cy1 = bounds
+    sent = self.sent.setdefault(viewer, set())
+    new = [
+      (cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+      if (cx, cy) not in sent
+    ]
+    if len(new) <= self.max_per_send:
+      self.last[viewer] = bounds
+    if not new:
+      return None
+    s = self.chunk_size
+    new.sort(key=lambda c: ((c[0] + .5) * s - x) ** 2 + ((c[1] + .5) * s - y) ** 2)
+    new = new[:self.max_per_send]
+    sent.update(new)
+    return b''.join(self.chunk(*c) for c in new)
@@ -3,8 +3,16 @@ import keys
 import aabb
 
 class Entity:
+  # subclasses without __slots__ (eg., Player) still get a __dict__, but
+  # short lived entities like bullets can do without one
+  __slots__ = (
+    'id', 'x', 'y', 'w', 'h',
+    'aabb_x', 'aabb_y', 'aabb_w', 'aabb_h', 'sprite_id',
+  )
 
   def __init__(self):
+    # unique id, assigned when the entity is added to the game
+    self.id = -1
     # position
     self.x = 0.
     self.y = 0.
@@ -19,6 +27,11 @@ class Entity:
     # graphics
     self.sprite_id = 0
 
+  def __hash__(self):
+    # hash on the id rather than the address, so sets of entities iterate in
+    # the same order every run (ids are assigned before entities go in sets)
+    return self.id
+
   def update_aabb(self):
     self.aabb_x = self.x - self.w
     self.aabb_y = self.y - self.h
@@ -38,7 +51,20 @@ class Entity:
   def collide_tile(self, tiles):
     pass
 
+  # health, entities that can't be hurt have none (and no health bar)
+  hp = 0
+  max_hp = 0
+  # velocity per second, only sent to clients (which use it to move entities
+  # along between snapshots)
+  vx = 0.
+  vy = 0.
+
+  # whether collide_tile is slide, then the game slides all such entities out
+  # of walls together with slide_all instead of calling it
+  slides = False
+
 class Player(Entity): # TODO move this
+  slides = True
 
   def __init__(self, game, player_id):
     super().__init__()
@@ -50,7 +76,7 @@ class Player(Entity): # TODO move this
     # movement
     self.dx = 0
     self.dy = 0
-    self.wasd_pressed = {key: False for key in ['w', 'a', 's', 'd']}
+    self.wasd_pressed = {key: False for key in [keys.W, keys.A, keys.S, keys.D]}
     self.speed = 7.2
     # rolling
     self.roll_cooldown = 0
@@ -67,10 +93,31 @@ class Player(Entity): # TODO move this
     self.flash_cooldown = 0 # tmp: damage flash demo purposes
     # graphics
     self.sprite_id = 1 + player_id % 2
+    # ids of entities always sent to this player, even out of view
+    self.tracked = set()
     # game stuff
     self.keys = keys.Keys()
     self.player_id = player_id
     self.game = game
+    # where the last tick started, for vx and vy
+    self.last_x = 0.
+    self.last_y = 0.
+    self.last_delta = 0.
+
+  @property
+  def vx(self):
+    # how fast we actually moved last tick, which is less than dx when a
+    # wall is in the way
+    return (self.x - self.last_x) / self.last_delta if self.last_delta else 0.
+
+  @property
+  def vy(self):
+    return (self.y - self.last_y) / self.last_delta if self.last_delta else 0.
+
+  @property
+  def input_seq(self):
+    # seq of the key update the player's keys are from, see Game.update_player_keys
+    return self.keys.seq
 
   def compute_reactive_wasd(self, key_p, key_n):
     # accepts key_p (key in positive dir) and key_n (key in negative dir)
@@ -101,11 +148,11 @@ class Player(Entity): # TODO move this
 
   def compute_wasd(self):
     # recompute wasd movement
-    self.dx = self.compute_reactive_wasd('d', 'a')
-    self.dy = self.compute_reactive_wasd('w', 's')
+    self.dx = self.compute_reactive_wasd(keys.D, keys.A)
+    self.dy = self.compute_reactive_wasd(keys.W, keys.S)
 
     mult = self.speed
-    if self.keys.pressed('shift') and not self.roll_cooldown and (self.dx or self.dy):
+    if self.keys.pressed(keys.SHIFT) and not self.roll_cooldown and (self.dx or self.dy):
       mult *= 3.
       self.roll_cooldown = self.max_roll_cooldown
 
@@ -135,13 +182,13 @@ class Player(Entity): # TODO move this
   def shoot(self):
     shoot_dx = 0
     shoot_dy = 0
-    if self.keys.pressed('arrowup'):
+    if self.keys.pressed(keys.UP):
       shoot_dy += 1
-    if self.keys.pressed('arrowleft'):
+    if self.keys.pressed(keys.LEFT):
       shoot_dx -= 1
-    if self.keys.pressed('arrowdown'):
+    if self.keys.pressed(keys.DOWN):
       shoot_dy -= 1
-    if self.keys.pressed('arrowright'):
+    if self.keys.pressed(keys.RIGHT):
       shoot_dx += 1
 
     self.cur_weapon.use(shoot_dx, shoot_dy)
@@ -156,11 +203,12 @@ class Player(Entity): # TODO move this
     return True
 
   def tick(self, delta):
+    self.last_x, self.last_y, self.last_delta = self.x, self.y, delta
     self.move(delta)
     self.shoot()
 
     # tmp: switch weapon for demo purposes
-    if self.keys.released(' '):
+    if self.keys.released(keys.SPACE):
       self.cur_weapon_idx += 1
       self.cur_weapon_idx %= len(self.weapons)
       self.cur_weapon = self.weapons[self.cur_weapon_idx]
@@ -172,38 +220,174 @@ class Player(Entity): # TODO move this
       self.flash_cooldown -= 1
 
   def collide_tile(self, tiles):
-    tiles.sort(key=lambda t: abs(t[0] + t[2]/2.- self.x) + abs(t[1] + t[3]/2. - self.y))
-    for tile_x, tile_y, tile_w, tile_h in tiles:
-      # calculate slide
-      dx, dy = aabb.collide_and_slide(
-        self.dx, self.dy,
-        self.aabb_x, self.aabb_y, self.aabb_w, self.aabb_h,
-        tile_x, tile_y, tile_w, tile_h,
-      )
-      # update pos
-      self.x += dx
-      self.y += dy
-      self.update_aabb()
+    slide(self, tiles)
 
 
-class Bullet(Entity):
+class Enemy(Entity):
+  # walks towards the nearest player along the game's flow fields (see
+  # flowfield.py) and hurts whoever it touches
+  slides = True
+
+  def __init__(self, game):
+    super().__init__()
+    self.w = 0.4
+    self.h = 0.4
+    # movement
+    self.dx = 0.
+    self.dy = 0.
+    self.speed = 4.
+    # how far away (in steps) players are noticed
+    self.sight = game.config.get('enemy_sight', 24)
+    # combat
+    self.hp = 30
+    self.max_hp = 30
+    self.dmg = 10
+    self.attack_cooldown = 0
+    self.max_attack_cooldown = 30
+    # who we are chasing, picked again every retarget_interval ticks
+    self.target = None
+    self.retarget_cooldown = 0
+    self.retarget_interval = 30
+    # graphics
+    self.sprite_id = 10
+    self.game = game
+    # where the last tick started, for vx and vy
+    self.last_x = 0.
+    self.last_y = 0.
+    self.last_delta = 0.
+
+  @property
+  def vx(self):
+    # how fast we actually moved last tick, which is less than dx when a
+    # wall is in the way
+    return (self.x - self.last_x) / self.last_delta if self.last_delta else 0.
+
+  @property
+  def vy(self):
+    return (self.y - self.last_y) / self.last_delta if self.last_delta else 0.
+
+  def find_target(self):
+    # closest player (as the crow flies) within sight
+    best = None
+    best_dist = self.sight
+    for player in self.game.players.values():
+      dist = max(abs(player.x - self.x), abs(player.y - self.y))
+      if dist < best_dist:
+        best = player
+        best_dist = dist
+    return best
 
-  def __init__(self, game, src, x, y, dir, momentum=(0, 0)):
+  def tick(self, delta):
+    self.last_x, self.last_y, self.last_delta = self.x, self.y, delta
+    if self.attack_cooldown:
+      self.attack_cooldown -= 1
+    if self.retarget_cooldown:
+      self.retarget_cooldown -= 1
+    else:
+      self.target = self.find_target()
+      # spread retargeting of different enemies over different ticks
+      self.retarget_cooldown = self.retarget_interval - 1 + self.id % 2
+    target = self.target
+    self.dx = self.dy = 0.
+    if target is None or self.game.players.get(target.player_id) is not target:
+      self.target = None
+      return
+    # tile x covers x - 0.5 to x + 0.5
+    tx, ty = int(round(target.x)), int(round(target.y))
+    x, y = int(round(self.x)), int(round(self.y))
+    if (x, y) == (tx, ty):
+      # on the same tile, go straight for them
+      dx, dy = target.x - self.x, target.y - self.y
+      norm = (dx * dx + dy * dy) ** 0.5
+      if norm < 1e-6:
+        return
+      dx, dy = dx / norm, dy / norm
+    else:
+      field = self.game.flow_fields.get(tx, ty)
+      if not 0 <= x < field.dist.shape[0] or not 0 <= y < field.dist.shape[1]:
+        return
+      dx, dy = field.direction(x, y)
+    self.dx = float(dx) * self.speed
+    self.dy = float(dy) * self.speed
+    self.x += delta * self.dx
+    self.y += delta * self.dy
+
+  def damage(self, dmg):
+    self.hp -= dmg
+    if self.hp <= 0:
+      self.game.remove_entity(self)
+    return True
+
+  def collide(self, other):
+    if type(other) is Player and not self.attack_cooldown and other.damage(self.dmg):
+      self.attack_cooldown = self.max_attack_cooldown
+
+  def collide_tile(self, tiles):
+    slide(self, tiles)
+
+
+def slide(e, tiles):
+  # push a moving entity out of the tiles it overlaps, sliding along them
+  slide_all([e], [tiles])
+
+def slide_all(entities, tiles):
+  # slide for many entities at once, tiles[i] are the tiles entities[i] hit
+  pos = aabb.slide_out(
+    [(e.x, e.y, e.w, e.h) for e in entities],
+    [(e.dx, e.dy) for e in entities],
+    [t for ts in tiles for t in ts],
+    [i for i, ts in enumerate(tiles) for _ in ts],
+  )
+  for e, (x, y) in zip(entities, pos.tolist()):
+    e.x = x
+    e.y = y
+    e.update_aabb()
+
+
+class Bullet(Entity):
+  # bullets are recycled by bullets.BulletPool, so everything about them is
+  # set in reset() rather than __init__
+  __slots__ = (
+    'dx', 'dy', 'mx', 'my', 'speed', 'dmg', 'lifespan',
+    'pierce_entities', 'pierce_walls', 'src_id', 'game',
+  )
+
+  def __init__(self, game, src, x, y, dir, momentum=(0, 0), **params):
+    self.game = game
+    self.reset(src, x, y, dir, momentum, **params)
+
+  def reset(
+      self, src, x, y, dir, momentum=(0, 0),
+      w=0.25, h=0.25, speed=25, lifespan=120, dmg=5, sprite_id=0,
+      pierce_entities=False, pierce_walls=False,
+  ):
+    self.id = -1
     self.x = x
     self.y = y
-    self.w = 0.25
-    self.h = 0.25
+    self.w = w
+    self.h = h
     self.dx, self.dy = dir
     self.mx, self.my = momentum
     # game info
-    self.speed = 25
-    self.dmg = 5 # do 5 damage
-    self.lifespan = 120
+    self.speed = speed
+    self.dmg = dmg
+    self.lifespan = lifespan
+    # piercing bullets keep going after a hit (they damage everything they
+    # touch every tick, eg., lasers)
+    self.pierce_entities = pierce_entities
+    self.pierce_walls = pierce_walls
     # graphics
-    self.sprite_id = 0
+    self.sprite_id = sprite_id
     # misc
-    self.src = src
-    self.game = game
+    self.src_id = src.id
+
+  @property
+  def vx(self):
+    return self.speed * self.dx + self.mx
+
+  @property
+  def vy(self):
+    return self.speed * self.dy + self.my
 
   def destroy(self, x, y):
     # TODO: spawn bullet destroy animation at x, y (eg., sparks) here
@@ -214,17 +398,38 @@ class Bullet(Entity):
       self.lifespan -= 1
     else:
       self.game.remove_entity(self)
+    x, y = self.x, self.y
     self.x += (self.speed * self.dx + self.mx) * delta
     self.y += (self.speed * self.dy + self.my) * delta
+    if not self.pierce_walls:
+      self.sweep_walls(x, y)
+
+  def sweep_walls(self, x, y):
+    # a bullet that moved further than its own size since x, y could have
+    # skipped over a wall, it is destroyed by walls anywhere along the move
+    # (same as in bullets.BulletStore.collide_tiles)
+    vx = self.x - x
+    vy = self.y - y
+    if abs(vx) <= 2 * self.w and abs(vy) <= 2 * self.h:
+      # the end of tick test in collide_tile catches anything
+      return
+    ax, ay, aw, ah = x - self.w, y - self.h, 2 * self.w, 2 * self.h
+    for tile in self.game.world.intersect(
+        min(ax, ax + vx), min(ay, ay + vy), aw + abs(vx), ah + abs(vy),
+    ):
+      if aabb.sweep(ax, ay, aw, ah, vx, vy, *tile) is not None:
+        self.destroy(self.x, self.y)
+        return
 
   def collide(self, other):
-    if self.src == other:
+    if self.src_id == other.id:
       return
-    if other.damage(self.dmg):
+    if other.damage(self.dmg) and not self.pierce_entities:
       self.destroy(other.x, other.y)
 
   def collide_tile(self, tiles):
-    self.destroy(self.x, self.y) # TODO return self.x self.y with one calculated from tiles
+    if not self.pierce_walls:
+      self.destroy(self.x, self.y) # TODO return self.x self.y with one calculated from tiles
 
   def damage(self, dmg):
     return False
@@ -0,0 +1,128 @@
+import collections
+
+import numpy as np
+
+# flow fields for enemy navigation: a breadth first search from a target tile
+# over every walkable tile gives each tile its distance to the target, and the
+# step to take from it. any number of enemies chasing the same target share
+# the field, and following it costs a lookup per enemy
+
+# neighbour steps, orthogonal ones first. diagonal steps are only allowed if
+# both orthogonal tiles next to them are walkable too (no cutting corners)
+STEPS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+DIAGONAL = 1. / np.sqrt(2.)
+
+UNREACHABLE = np.iinfo(np.int32).max
+WALL = -1
+
+class Graph:
+  # the walkable tiles of a world and their neighbours, shared by all of its
+  # flow fields. tiles are flat indices into the grid padded with a border of
+  # walls, so neighbours never need bounds checks
+
+  def __init__(self, walkable):
+    self.shape = walkable.shape
+    width, height = walkable.shape
+    pw = height + 2
+    open_ = np.zeros((width + 2, pw), dtype=bool)
+    open_[1:-1, 1:-1] = walkable
+    open_ = open_.ravel()
+    self.size = len(open_)
+    # distances start out as this, walls stay WALL
+    self.blank = np.where(open_, UNREACHABLE, WALL).astype(np.int32)
+    # neighbours of every tile, disallowed steps lead to tile 0 (a wall)
+    self.cells = np.flatnonzero(open_)
+    cells = self.cells
+    self.neighbours = np.zeros((self.size, len(STEPS)), dtype=np.intp)
+    for i, (dx, dy) in enumerate(STEPS):
+      nb = cells + dx * pw + dy
+      ok = open_[nb]
+      if dx and dy:
+        ok &= open_[cells + dx * pw] & open_[cells + dy]
+      self.neighbours[cells, i] = np.where(ok, nb, 0)
+
+  def unpad(self, a):
+    width, height = self.shape
+    return a.reshape(width + 2, height + 2)[1:-1, 1:-1]
+
+class FlowField:
+  # distance to the target and unit direction towards it of every tile.
+  # tiles that can't reach the target (walls, closed off rooms, or further
+  # than max_dist) have a direction of (0, 0)
+
+  step_dx = np.array([dx for dx, _ in STEPS] + [0], dtype=np.float32)
+  step_dy = np.array([dy for _, dy in STEPS] + [0], dtype=np.float32)
+  step_dx[4:8] *= DIAGONAL
+  step_dy[4:8] *= DIAGONAL
+
+  def __init__(self, graph, tx, ty, max_dist=None):
+    self.target = (tx, ty)
+    dist = graph.blank.copy()
+    start = (tx + 1) * (graph.shape[1] + 2) + ty + 1
+    reached = []
+    if dist[start] == UNREACHABLE:
+      # breadth first, one wavefront per step
+      dist[start] = 0
+      frontier = np.array([start])
+      d = 0
+      while len(frontier) and (max_dist is None or d < max_dist):
+        reached.append(frontier)
+        d += 1
+        found = graph.neighbours[frontier].ravel()
+        frontier = np.unique(found[dist[found] == UNREACHABLE])
+        dist[frontier] = d
+      reached.append(frontier)
+    dist[dist == WALL] = UNREACHABLE
+
+    # step to the neighbour closest to the target, only reached tiles have one
+    cells = np.concatenate(reached) if reached else np.zeros(0, dtype=np.intp)
+    nd = dist[graph.neighbours[cells]]
+    best = nd.argmin(axis=1)
+    step = np.full(graph.size, len(STEPS), dtype=np.intp)
+    closer = nd[np.arange(len(cells)), best] < dist[cells]
+    step[cells[closer]] = best[closer]
+
+    step = graph.unpad(step)
+    self.dist = graph.unpad(dist)
+    self.dx = self.step_dx[step]
+    self.dy = self.step_dy[step]
+
+  def direction(self, x, y):
+    # direction to go in from tile x, y
+    return self.dx[x, y], self.dy[x, y]
+
+class FlowFieldCache:
+  # flow fields of a world by target tile, the least recently used ones are
+  # dropped once there are more than `capacity`. fields are only computed
+  # when first asked for, ie., when a target moves onto a new tile
+
+  def __init__(self, world, capacity=64, max_dist=None):
+    self.graph = Graph(~np.asarray(world.collision_mask))
+    self.capacity = capacity
+    self.max_dist = max_dist
+    self.fields = collections.OrderedDict() # (x, y) -> FlowField
+    # counters
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, tx, ty):
+    field = self.fields.get((tx, ty))
+    if field is not None:
+      self.hits += 1
+      self.fields.move_to_end((tx, ty))
+      return field
+    self.misses += 1
+    field = self.fields[(tx, ty)] = FlowField(self.graph, tx, ty, self.max_dist)
+    if len(self.fields) > self.capacity:
+      self.fields.popitem(last=False)
+      self.evictions += 1
+    return field
+
+  def stats(self):
+    return {
+      'fields': len(self.fields),
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+    }
@@ -1,24 +1,73 @@
-import asyncio as aio
-import time
 import random
 
 import numpy as np
 
-import server as se
-import aabb
-
+import bullets
+import chunks
 import entity
+import flowfield
+import keys
+import levels
+import metrics
+import output
+import scheduler
+import snapshot
+import spatial
 import world
+import worldcache
 
 class Game:
 
-  def __init__(self, config):
+  def __init__(self, config, sink=None, ring=None):
+    # sink is where messages for the clients go (see output.py), by default
+    # they are encoded but not delivered anywhere. with a snapshot ring (see
+    # snapring.py), the state is published there instead, for another process
+    # to encode and send
     self.config = config
-    self.first_tick = True
+    self.current_tick = 0
+    # everything sent to the clients goes through the output sink
+    self.output = sink if sink is not None else output.Sink()
+    self.ring = ring
 
-    self.world = world.gen_dungeon()
+    self.level = 0
+    # enemies are placed with their own rng, so they don't take numbers away
+    # from anything else
+    self.rng = random.Random(config.get('seed'))
+    if config.get('world_cache'):
+      self.set_world(worldcache.load_dungeon(config.world_cache, **config.get('world', {})))
+    else:
+      self.set_world(world.gen_dungeon(**config.get('world', {})))
+    # the next levels are generated in the background, players go down a level
+    # by stepping on the end tile (disabled if no levels are generated ahead)
+    self.levels = None
+    if config.get('levels_ahead'):
+      self.levels = levels.LevelPipeline(
+        config.get('world'), config.levels_ahead,
+        config.get('level_workers', 1), config.get('world_cache'),
+      )
+    # per phase timings, see metrics.py
+    self.profiler = metrics.Profiler(config.get('profile', False))
+    # players are only sent entities within this distance (None sends all)
+    self.interest_radius = config.get('interest_radius', 20.)
+    # per player delta compression of the entity snapshots
+    self.deltas = snapshot.DeltaEncoder(config.get('keyframe_interval', 120))
+    # simulation runs at config.tps, the clients are sent updates at send_rate
+    self.scheduler = scheduler.FixedStepScheduler(
+      self.step, self.send if ring is None else self.publish, config.tps,
+      send_rate=config.get('send_rate'),
+      max_steps=config.get('max_catchup_steps', 4),
+      spin=config.get('tick_spin', 0.),
+    )
+    # broadphase for entity vs entity collisions, rebuilt every tick
+    self.broadphase = spatial.SpatialHash()
 
     self.entities = set()
+    self.next_entity_id = 0
+    # ordinary bullets live in an array backed store instead of self.entities
+    # (can be disabled, then every bullet is an entity.Bullet object)
+    self.bullets = bullets.BulletStore() if config.get('bullet_store', True) else None
+    # bullet objects are recycled
+    self.bullet_pool = bullets.BulletPool(self)
     # since we cannot modify a set while we iterate over it,
     # we buffer all changes we would like to make to a set until after the
     # current tick is over
@@ -27,6 +76,68 @@ class Game:
     self.players = {}
     self.add_players_buffer = []
     self.remove_players_buffer = []
+    self.spawn_enemies(config.get('enemies_per_level', 0))
+
+  def set_world(self, w):
+    self.world = w
+    # the map is streamed to each player in chunks as they get near them
+    self.chunks = chunks.ChunkStreamer(
+      w, self.config.get('chunk_size', 16), self.config.get('chunk_radius', 24.),
+    )
+    # enemies find their way to players with flow fields, shared between all
+    # enemies chasing the same tile
+    self.flow_fields = flowfield.FlowFieldCache(
+      w, self.config.get('flow_field_cache', 64), self.config.get('enemy_sight', 24),
+    )
+    self.output.world_changed(self.level, w)
+
+  def descend(self):
+    # moves everyone down to the next level. returns False if it isn't
+    # generated yet (then players can just try again)
+    level = self.levels.next()
+    if level is None:
+      return False
+    _, w = level
+    self.level += 1
+    self.set_world(w)
+    # bullets and enemies don't come along, the new level has its own enemies
+    if self.bullets is not None:
+      self.bullets.clear()
+    for e in self.entities:
+      if type(e) in (entity.Bullet, entity.Enemy):
+        self.remove_entity(e)
+    self.spawn_enemies(self.config.get('enemies_per_level', 0))
+    for player in self.players.values():
+      player.x = player.last_x = w.spawnx
+      player.y = player.last_y = w.spawny
+      player.update_aabb()
+    # clients drop the map they have, the chunks of the new one follow
+    self.output.broadcast('level', self.output.encode('level', self.level), droppable=False)
+    return True
+
+  def spawn_enemies(self, n):
+    # n enemies on random floor tiles, away from the spawn
+    w = self.world
+    xs, ys = np.nonzero((np.asarray(w.tiles) != 0) & ~np.asarray(w.collision_mask))
+    far = np.maximum(abs(xs - w.spawnx), abs(ys - w.spawny)) > self.config.get('enemy_spawn_distance', 12)
+    xs, ys = xs[far].tolist(), ys[far].tolist()
+    for _ in range(n if xs else 0):
+      i = self.rng.randrange(len(xs))
+      enemy = entity.Enemy(self)
+      enemy.x = float(xs[i])
+      enemy.y = float(ys[i])
+      self.add_entity(enemy)
+
+  def on_end_tile(self, player):
+    # tile x covers x - 0.5 to x + 0.5
+    tiles = self.world.tiles
+    x = int(round(player.x))
+    y = int(round(player.y))
+    return 0 <= x < tiles.shape[0] and 0 <= y < tiles.shape[1] and tiles[x, y] == world.END_TILE
+
+  def close(self):
+    if self.levels is not None:
+      self.levels.close()
 
   def new_player(self, player_id):
     player = entity.Player(self, player_id)
@@ -38,12 +149,33 @@ class Game:
   def remove_player(self, player_id):
     self.remove_players_buffer.append(player_id)
 
+  def new_entity_id(self):
+    self.next_entity_id += 1
+    return self.next_entity_id
+
   def add_entity(self, entity):
+    entity.id = self.new_entity_id()
     self.add_entities_buffer.add(entity)
 
   def remove_entity(self, entity):
     self.remove_entities_buffer.add(entity)
 
+  def spawn_bullet(self, src, x, y, dir, momentum=(0, 0), **params):
+    # params are any of the arguments of entity.Bullet.reset (w, h, speed,
+    # lifespan, dmg, ...). returns the id of the new bullet
+    if (
+        self.bullets is not None
+        and not params.get('pierce_entities')
+        and not params.get('pierce_walls')
+    ):
+      # the store only does ordinary bullets
+      bullet_id = self.new_entity_id()
+      self.bullets.spawn(bullet_id, src.id, x, y, dir, momentum, **params)
+      return bullet_id
+    bullet = self.bullet_pool.acquire(src, x, y, dir, momentum, **params)
+    self.add_entity(bullet)
+    return bullet.id
+
   def flush_add_entities_buffer(self):
     self.entities |= self.add_entities_buffer
     self.add_entities_buffer.clear()
@@ -53,9 +185,11 @@ class Game:
     self.add_players_buffer.clear()
 
   def flush_remove_entities_buffer(self):
-    for entity in self.remove_entities_buffer:
-      if entity in self.entities:
-        self.entities.remove(entity)
+    for e in self.remove_entities_buffer:
+      if e in self.entities:
+        self.entities.remove(e)
+        if type(e) is entity.Bullet:
+          self.bullet_pool.release(e)
     self.remove_entities_buffer.clear()
 
     for player_id in self.remove_players_buffer:
@@ -63,82 +197,185 @@ class Game:
       if player in self.entities:
         self.entities.remove(player)
       self.players.pop(player_id)
+      self.deltas.forget(player_id)
+      self.chunks.forget(player_id)
     self.remove_players_buffer.clear()
 
   def flush_entities_buffer(self):
     self.flush_add_entities_buffer()
     self.flush_remove_entities_buffer()
 
-  def update_player_keys(self, player_id, keys):
+  def update_player_keys(self, player_id, mask, seq=None):
+    # mask has the bits of the held keys set (see keys.py). seq numbers the
+    # key updates of a player, the last one applied is echoed back in their
+    # snapshots (so clients can measure their latency)
     if player_id in self.players:
       self.players[player_id].keys.update(
-        {key for key, val in keys.items() if val == True}
+        mask & keys.ALL, seq & 0xffffffff if seq is not None else None,
+      )
+
+  def interest(self, player, snap, index):
+    # indices of the entities of snap the player should be sent: everything
+    # within the interest radius, plus whatever the player tracks
+    r = self.interest_radius
+    idx = index.query(player.x - r, player.y - r, player.x + r, player.y + r)
+    if player.tracked:
+      tracked = list(player.tracked)
+      tracked_idx, found = snap.find(tracked)
+      # ids are never reused, so tracked entities that are gone can be dropped
+      player.tracked.difference_update(
+        id for id, f in zip(tracked, found.tolist()) if not f
       )
+      idx = np.union1d(idx, tracked_idx[found])
+    return idx
 
-  async def tick(self, delta):
-    if self.first_tick:
-      await se.sio.emit('world', self.world.render)
+  def ack_snapshot(self, player_id, tick):
+    # the player has applied the snapshot of this tick, future deltas can be
+    # encoded against it
+    self.deltas.ack(player_id, tick)
+
+  def tick(self, delta):
+    self.step(delta)
+    self.send()
+
+  def step(self, delta):
+    # advance the simulation by delta seconds
+    prof = self.profiler
+    step_start = t = prof.start()
+    self.current_tick += 1
     self.flush_entities_buffer()
-    for entity in self.entities:
-      entity.tick(delta)
+    # apply the key updates received since the last tick
+    for player in self.players.values():
+      player.keys.tick()
+    # tick the bullet store first, so bullets fired this tick don't move yet
+    # (same as bullet objects, which are only added after the entity ticks)
+    if self.bullets is not None:
+      self.bullets.tick(delta)
+    for e in self.entities:
+      e.tick(delta)
+    t = prof.lap('entity_tick', t)
     # can only flush add entities buffer here
     # this way, entities that only live for 1 frame will be displayed temporarily
     # self.flush_add_entities_buffer()
     self.flush_entities_buffer()
-    for entity in self.entities:
-      entity.update_aabb()
-      int = self.world.intersect(
-        entity.aabb_x, entity.aabb_y, entity.aabb_w, entity.aabb_h
-      )
+    # find who touches a wall with one vectorized test, then only look up
+    # the walls of those. players and enemies are pushed out of walls in one
+    # batch
+    ents = list(self.entities)
+    boxes = []
+    for e in ents:
+      e.update_aabb()
+      boxes.append((e.aabb_x, e.aabb_y, e.aabb_w, e.aabb_h))
+    touching = []
+    if ents:
+      touching = self.world.any_wall(*np.array(boxes).T).nonzero()[0].tolist()
+    sliding = []
+    sliding_tiles = []
+    for i in touching:
+      e = ents[i]
+      int = self.world.intersect(e.aabb_x, e.aabb_y, e.aabb_w, e.aabb_h)
       if int:
-        entity.collide_tile(int)
+        if e.slides:
+          sliding.append(e)
+          sliding_tiles.append(int)
+        else:
+          e.collide_tile(int)
+    if sliding:
+      entity.slide_all(sliding, sliding_tiles)
+    if self.bullets is not None:
+      self.bullets.collide_tiles(self.world)
+    t = prof.lap('tile_collision', t)
+    if self.levels is not None and any(map(self.on_end_tile, self.players.values())):
+      self.descend()
+      self.flush_entities_buffer()
     # same note as above here, we can only flush add entities here if we want
     self.flush_entities_buffer()
-    for e1 in self.entities:
-      for e2 in self.entities:
-        if e1 is e2:
-          # don't collide with itself
-          continue
-        if aabb.intersect(
-            e1.aabb_x, e1.aabb_y, e1.aabb_w, e1.aabb_h,
-            e2.aabb_x, e2.aabb_y, e2.aabb_w, e2.aabb_h,
-        ):
-          e1.collide(e2)
-    # tick player i/o
+    # entities that were pushed out of walls have their aabbs updated already
+    self.broadphase.rebuild(self.entities)
+    for e1, e2 in self.broadphase.colliding_pairs():
+      # each pair is only visited once, so collide both ways
+      e1.collide(e2)
+      e2.collide(e1)
+    # entities colliding with store bullets would only try to damage them,
+    # and bullets can't be damaged, so only the bullet side needs dispatching
+    if self.bullets is not None:
+      self.bullets.collide_entities(self.entities)
+    t = prof.lap('entity_collision', t)
+    prof.lap('step', step_start)
+
+  def send(self):
+    # send the current state to the clients
+    prof = self.profiler
+    send_start = t = prof.start()
+    sent = 0
+    # chunks of the map players came close to, these can't be dropped since
+    # they are only sent once
     for player in self.players.values():
-      player.keys.tick()
-    entity_list = list(self.entities)
-    entity_data = [[e.x, e.y, e.w, e.h, e.sprite_id, False] for e in entity_list]
-    for i, entity in enumerate(entity_list):
-      if hasattr(entity, 'player_id'):
-        entity_data[i][5] = True
-        await se.sio.emit('entities',
-          entity_data,
-          room=se.player_id_map_inv[entity.player_id],
+      payload = self.chunks.encode(player.player_id, player.x, player.y)
+      if payload is not None:
+        prof.record('chunk_bytes', len(payload))
+        sent += self.output.send(
+          player.player_id, 'world', self.output.encode('world', payload),
+          droppable=False,
         )
-        entity_data[i][5] = False
-    await se.sio.emit('health',
-      # hasattr sketch?
-      [(e.x, e.y, e.w, e.h, e.hp, e.max_hp) for e in self.entities if hasattr(e, 'hp')]
-    )
+    t = prof.lap('world', t)
+    # each player gets a delta of what is around them against the last snapshot
+    # they acknowledged. without interest management players share the same
+    # view, and players with the same base share one encoding
+    snap = snapshot.Snapshot.capture(self.current_tick, self.entities, self.bullets)
+    self.deltas.begin_tick()
+    if self.interest_radius is not None:
+      index = spatial.GridIndex(
+        snap.states['x'], snap.states['y'], snap.states['w'], snap.states['h'],
+      )
+    t = prof.lap('snapshot', t)
+    for player in self.players.values():
+      if self.interest_radius is None:
+        view = snap
+      else:
+        view = snap.select(self.interest(player, snap, index))
+      payload = self.deltas.encode(player.player_id, view, player.id, player.input_seq)
+      prof.record('snapshot_bytes', len(payload))
+      sent += self.output.send(
+        player.player_id, snapshot.send_key(payload), self.output.encode('entities', payload),
+      )
+    prof.lap('encode', t)
+    prof.record('bytes_per_send', sent)
+    self.output.flush()
+    prof.lap('send', send_start)
 
-  async def game_loop(self):
-    # all times in seconds
-    dt = 1. / self.config.tps
-    next_tick_target = time.time() + dt
-    ticks = 0
-    last_print_time = time.time()
-
-    while 1:
-      await self.tick(dt)
-      ticks += 1
-      if ticks % 60 == 0:
-        now = time.time()
-        print(f"TPS: {self.config.tps / (now - last_print_time):.2f}")
-        last_print_time = now
-      now = time.time()
-      while now < next_tick_target:
-        await aio.sleep(0.001)
-        now = time.time()
-      next_tick_target += dt
+  def publish(self):
+    # send() for when another process serves the clients: the state every
+    # client is sent gets published into the snapshot ring instead
+    prof = self.profiler
+    t = prof.start()
+    self.output.flush()
+    snap = snapshot.Snapshot.capture(self.current_tick, self.entities, self.bullets)
+    records, players = self.ring.begin()
+    n = len(snap)
+    if n > len(records):
+      # no room for the newest entities
+      self.ring.overflows += 1
+      n = len(records)
+    records = records[:n]
+    records['id'] = snap.ids[:n]
+    for field in snapshot.FIELDS:
+      records[field] = snap.states[field][:n]
+    records['tracker'] = 0
+    m = min(len(self.players), len(players))
+    for i, player in enumerate(list(self.players.values())[:m]):
+      players[i] = (player.player_id, player.id, player.input_seq)
+      if player.tracked:
+        tracked = list(player.tracked)
+        idx, found = snap.find(tracked)
+        # same as in interest, ids are never reused
+        player.tracked.difference_update(
+          id for id, f in zip(tracked, found.tolist()) if not f
+        )
+        idx = idx[found]
+        records['tracker'][idx[idx < n]] = player.id
+    self.ring.commit(self.current_tick, self.level, n, m)
+    prof.lap('publish', t)
 
+  async def game_loop(self):
+    await self.scheduler.run()
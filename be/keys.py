@@ -1,19 +1,44 @@
+# keys are sent as a bitmask, the bit of each key is its index here
+# (KEY_BITS in fe/app.js has the same keys, keep the two in sync)
+NAMES = ['w', 'a', 's', 'd', 'arrowup', 'arrowleft', 'arrowdown', 'arrowright', 'shift', ' ']
+W, A, S, D, UP, LEFT, DOWN, RIGHT, SHIFT, SPACE = (1 << i for i in range(len(NAMES)))
+ALL = (1 << len(NAMES)) - 1
+
+def mask(names):
+  # mask of the named keys, unknown names are ignored
+  return sum(1 << NAMES.index(name) for name in set(names) if name in NAMES)
 
 class Keys:
+  # keys held by a player. updates are coalesced into one input per tick and
+  # only take effect in tick(), so keys never change halfway through a tick
 
   def __init__(self):
-    self.keys = {}
-    self.last_keys = {}
+    self.keys = 0
+    self.last_keys = 0
+    # seq of the update the current keys are from
+    self.seq = 0
+    # received since the last tick: the latest keys and seq, and every key
+    # that was held at some point
+    self.next_keys = 0
+    self.next_seq = 0
+    self.seen = 0
 
-  def update(self, keys):
-    self.keys = keys
+  def update(self, keys, seq=None):
+    self.next_keys = keys
+    self.seen |= keys
+    if seq is not None:
+      self.next_seq = seq
 
   def pressed(self, key):
-    return key in self.keys
+    return bool(self.keys & key)
 
   def released(self, key):
-    return key in self.last_keys and key not in self.keys
+    return bool(self.last_keys & key) and not self.keys & key
 
   def tick(self):
+    # start of a tick, apply the updates received since the last one. keys
+    # that were pressed and let go again in between count as held for a tick
     self.last_keys = self.keys
-
+    self.keys = self.next_keys | (self.seen & ~self.last_keys)
+    self.seen = self.next_keys
+    self.seq = self.next_seq
@@ -0,0 +1,130 @@
+import collections
+import concurrent.futures
+import os
+import traceback
+
+import world
+import worldcache
+
+# the levels below the current one are generated ahead of time in worker
+# processes, so going down a level never has to wait for world generation (and
+# generation never stalls the tick loop)
+
+def init_worker():
+  # generation shouldn't take cpu time away from the tick loop
+  try:
+    os.nice(10)
+  except (AttributeError, OSError):
+    pass
+
+def generate(params, cache_dir=None):
+  # runs in a worker process. without a cache the world itself is sent back,
+  # with one it is saved there and only its path is, so the game can memory
+  # map it instead of copying it around
+  if cache_dir is None:
+    return world.gen_dungeon(**params)
+  worldcache.load_dungeon(cache_dir, **params)
+  return worldcache.level_path(cache_dir, **params)
+
+class LevelPipeline:
+  # keeps the next `ahead` levels generating or generated, in order. level n
+  # is generated with the params of the first level and its seed + n (seeds
+  # that don't give a connected dungeon are skipped)
+
+  def __init__(self, params=None, ahead=2, workers=1, cache_dir=None):
+    self.params = worldcache.dungeon_params(**(params or {}))
+    self.ahead = ahead
+    self.cache_dir = cache_dir
+    self.next_seed = self.params['seed'] + 1
+    self.workers = workers
+    self.pool = self.new_pool()
+    self.queue = collections.deque() # (seed, future), in level order
+    # counters
+    self.generated = 0
+    self.failed = 0
+    self.restarts = 0 # pools replaced after a worker died
+    self.fill()
+
+  def new_pool(self):
+    return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_worker)
+
+  def restart(self):
+    # a worker died and took the pool with it. whatever was queued is lost,
+    # and generated again in the new pool
+    self.restarts += 1
+    self.pool.shutdown(wait=False, cancel_futures=True)
+    self.pool = self.new_pool()
+    if self.queue:
+      self.next_seed = self.queue[0][0]
+      self.queue.clear()
+
+  def fill(self):
+    restarted = False
+    while len(self.queue) < self.ahead:
+      seed = self.next_seed
+      params = {**self.params, 'seed': seed}
+      try:
+        future = self.pool.submit(generate, params, self.cache_dir)
+      except concurrent.futures.BrokenExecutor:
+        if restarted:
+          # try again on the next call
+          return
+        print('levels: worker pool broken, restarting it')
+        self.restart()
+        restarted = True
+        continue
+      self.next_seed += 1
+      self.queue.append((seed, future))
+
+  def ready(self):
+    # number of levels at the front of the queue that are done
+    n = 0
+    for _, future in self.queue:
+      if not future.done():
+        break
+      n += 1
+    return n
+
+  def next(self):
+    # the next level as (seed, World), or None if it isn't generated yet.
+    # never blocks, and never raises: a level that fails to generate or load
+    # is skipped, the one after it takes its place
+    while self.queue and self.queue[0][1].done():
+      seed, future = self.queue.popleft()
+      try:
+        result = future.result()
+        if isinstance(result, str):
+          result = world.World.load(result)
+      except concurrent.futures.BrokenExecutor:
+        print(f'levels: worker died generating seed {seed}, restarting the pool')
+        self.failed += 1
+        self.restart()
+        self.fill()
+        return None
+      except RuntimeError:
+        # bad seed, no connected dungeon
+        self.failed += 1
+        self.fill()
+        continue
+      except Exception:
+        print(f'levels: failed to generate seed {seed}')
+        traceback.print_exc()
+        self.failed += 1
+        self.fill()
+        continue
+      self.generated += 1
+      self.fill()
+      return seed, result
+    return None
+
+  def stats(self):
+    return {
+      'ready': self.ready(),
+      'queued': len(self.queue),
+      'generated': self.generated,
+      'failed': self.failed,
+      'restarts': self.restarts,
+    }
+
+  def close(self):
+    self.pool.shutdown(cancel_futures=True)
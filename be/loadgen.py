@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+# load generator for a running server (python run.py): opens more and more
+# socket.io clients that play like browsers do, and measures what each of them
+# receives. the player count is raised in stages until the server can't keep
+# up its tick rate any more
+#
+# every client measures
+#   jitter:  spread of the time between consecutive snapshots
+#   latency: time from sending a key update to receiving the first snapshot
+#            that echoes its seq (ie., that was simulated with those keys)
+#   bytes:   payload bytes received
+# the server's tick rate is measured from the ticks of the snapshots received.
+# hundreds of clients also keep this process busy, if the client lag it
+# reports grows, the numbers are no longer trustworthy
+#
+# usage: python loadgen.py [--url URL] [--start N] [--step N] [--max N] ...
+
+import argparse
+import asyncio as aio
+import json
+import random
+import time
+
+import numpy as np
+import socketio
+
+import bench
+import keys
+import snapshot
+
+class Stats:
+  # measurements of one client over the current stage
+
+  def __init__(self):
+    self.intervals = []
+    self.latencies = []
+    self.bytes = 0
+    self.snapshots = 0
+    self.first_tick = None
+    self.last_tick = None
+
+class LoadClient:
+  # plays like a browser: keys change every so often and are sent at most
+  # once per frame, and every snapshot is acknowledged
+
+  def __init__(self, url, rng, fps=60):
+    self.url = url
+    self.rng = rng
+    self.frame = 1. / fps
+    self.sio = socketio.AsyncClient(reconnection=False)
+    self.sio.on('entities', self.on_entities)
+    self.sio.on('world', self.on_world)
+    self.stats = Stats()
+    self.seq = 0
+    self.sent = {} # seq -> time the key update was sent
+    self.echoed = 0
+    self.last_arrival = None
+    self.lag = 0. # worst lateness of our own frames, in seconds
+    self.task = None
+
+  async def connect(self):
+    await self.sio.connect(self.url, transports=['websocket'])
+    self.task = aio.get_event_loop().create_task(self.play())
+
+  async def disconnect(self):
+    if self.task is not None:
+      self.task.cancel()
+    await self.sio.disconnect()
+
+  def reset(self):
+    # start a new stage
+    self.stats = Stats()
+    self.lag = 0.
+
+  async def on_entities(self, buf):
+    now = time.perf_counter()
+    stats = self.stats
+    _, _, tick, _, _, input_seq, _, _, _ = snapshot.HEADER.unpack_from(buf)
+    if self.last_arrival is not None:
+      stats.intervals.append(now - self.last_arrival)
+    self.last_arrival = now
+    stats.bytes += len(buf)
+    stats.snapshots += 1
+    if stats.first_tick is None:
+      stats.first_tick = tick
+    stats.last_tick = tick
+    if input_seq > self.echoed:
+      self.echoed = input_seq
+      sent = self.sent.pop(input_seq, None)
+      if sent is not None:
+        stats.latencies.append(now - sent)
+      # updates that were overtaken will never be echoed
+      for seq in [seq for seq in self.sent if seq < input_seq]:
+        del self.sent[seq]
+    await self.sio.emit('ack', tick)
+
+  async def on_world(self, buf):
+    self.stats.bytes += len(buf)
+
+  async def play(self):
+    rng = self.rng
+    move, move_frames = (), 0
+    aim, aim_frames = (), 0
+    mask = 0
+    next_frame = time.perf_counter()
+    while True:
+      changed = False
+      if move_frames <= 0:
+        move, move_frames, changed = rng.choice(bench.MOVES), rng.randint(20, 90), True
+      move_frames -= 1
+      if aim_frames <= 0:
+        aim = rng.choice(bench.AIMS) if not aim and rng.random() < 0.7 else ()
+        aim_frames, changed = rng.randint(10, 60), True
+      aim_frames -= 1
+      roll = bool(move) and rng.random() < 0.02
+      if roll or mask & keys.SHIFT:
+        changed = True
+      if changed:
+        mask = keys.mask(move + aim) | (keys.SHIFT if roll else 0)
+        self.seq += 1
+        self.sent[self.seq] = time.perf_counter()
+        await self.sio.emit('input', [self.seq, mask])
+
+      next_frame += self.frame
+      delay = next_frame - time.perf_counter()
+      if delay > 0:
+        await aio.sleep(delay)
+      late = time.perf_counter() - next_frame
+      self.lag = max(self.lag, late)
+      if late > self.frame:
+        # too far behind, don't try to catch up
+        next_frame = time.perf_counter()
+
+def summarize(clients, duration):
+  stats = [c.stats for c in clients]
+  intervals = np.array([i for s in stats for i in s.intervals])
+  latencies = np.array([l for s in stats for l in s.latencies])
+  ticks = [s.last_tick - s.first_tick for s in stats if s.first_tick is not None]
+
+  def ms(a, q):
+    return 1e3 * float(np.quantile(a, q)) if len(a) else float('nan')
+
+  return {
+    'players': len(clients),
+    # the client that saw the most ticks go by saw the server's tick rate
+    'server_tps': max(ticks) / duration if ticks else 0.,
+    'snapshots_per_second': sum(s.snapshots for s in stats) / duration / len(stats),
+    'interval_ms': 1e3 * float(intervals.mean()) if len(intervals) else float('nan'),
+    'jitter_ms': 1e3 * float(intervals.std()) if len(intervals) else float('nan'),
+    'interval_p99_ms': ms(intervals, 0.99),
+    'latency_p50_ms': ms(latencies, 0.5),
+    'latency_p99_ms': ms(latencies, 0.99),
+    'bytes_per_second': sum(s.bytes for s in stats) / duration / len(stats),
+    'client_lag_ms': 1e3 * max(c.lag for c in clients),
+  }
+
+def report(r):
+  print(
+    f"{r['players']:>5} players: {r['server_tps']:6.1f} tps, "
+    f"{r['snapshots_per_second']:5.1f} snapshots/s, "
+    f"interval {r['interval_ms']:6.2f}ms (jitter {r['jitter_ms']:.2f}, p99 {r['interval_p99_ms']:.2f}), "
+    f"latency p50 {r['latency_p50_ms']:.1f}ms p99 {r['latency_p99_ms']:.1f}ms, "
+    f"{r['bytes_per_second'] / 1024:.1f} KiB/s per client, "
+    f"client lag {r['client_lag_ms']:.1f}ms"
+  )
+
+async def run(args):
+  rng = random.Random(args.seed)
+  clients = []
+  results = []
+  limit = None
+  connecting = aio.Semaphore(args.connect_concurrency)
+
+  async def connect(client):
+    async with connecting:
+      await client.connect()
+
+  try:
+    players = args.start
+    while players <= args.max:
+      new = [
+        LoadClient(args.url, random.Random(rng.getrandbits(64)), args.fps)
+        for _ in range(players - len(clients))
+      ]
+      await aio.gather(*(connect(c) for c in new))
+      clients += new
+      await aio.sleep(args.settle)
+      for c in clients:
+        c.reset()
+      start = time.perf_counter()
+      await aio.sleep(args.duration)
+      result = summarize(clients, time.perf_counter() - start)
+      results.append(result)
+      if not args.json:
+        report(result)
+      if result['server_tps'] < args.tps * (1. - args.tolerance):
+        limit = players
+        break
+      players += args.step
+  finally:
+    await aio.gather(*(c.disconnect() for c in clients), return_exceptions=True)
+
+  if args.json:
+    print(json.dumps({'stages': results, 'limit': limit}, indent=2))
+  elif limit is None:
+    print(f'server kept up {args.tps} tps with up to {args.max} players')
+  else:
+    print(f'server fell below {args.tps} tps at {limit} players')
+
+def main():
+  parser = argparse.ArgumentParser(description='socket.io load generator')
+  parser.add_argument('--url', default='http://localhost:6942')
+  parser.add_argument('--tps', type=float, default=60, help="the server's configured tps")
+  parser.add_argument('--tolerance', type=float, default=0.05,
+    help='fraction of tps the server may fall short by before it counts as overloaded')
+  parser.add_argument('--start', type=int, default=10, help='players in the first stage')
+  parser.add_argument('--step', type=int, default=10, help='players added each stage')
+  parser.add_argument('--max', type=int, default=500, help='most players to try')
+  parser.add_argument('--settle', type=float, default=2., help='seconds to wait after connecting')
+  parser.add_argument('--duration', type=float, default=5., help='seconds to measure each stage')
+  parser.add_argument('--fps', type=float, default=60, help='frame rate of the clients')
+  parser.add_argument('--connect-concurrency', type=int, default=20)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--json', action='store_true', help='print results as json')
+  args = parser.parse_args()
+  aio.run(run(args))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,172 @@
+import collections
+import time
+
+import numpy as np
+
+class Histogram:
+  # keeps the last `window` samples for quantiles, and running totals
+
+  def __init__(self, window=1024):
+    self.samples = np.zeros(window)
+    self.count = 0
+    self.sum = 0.
+    self.max = 0.
+
+  def add(self, value):
+    self.samples[self.count % len(self.samples)] = value
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def quantile(self, q):
+    n = min(self.count, len(self.samples))
+    if not n:
+      return 0.
+    return float(np.quantile(self.samples[:n], q))
+
+  def summary(self):
+    return {
+      'p50': self.quantile(0.5),
+      'p99': self.quantile(0.99),
+      'max': self.max,
+      'count': self.count,
+      'sum': self.sum,
+    }
+
+class Profiler:
+  # per phase timings of the game loop. usage:
+  #   t = profiler.start()
+  #   ...
+  #   t = profiler.lap('phase', t)
+  # when disabled both calls return right away, so instrumented code costs
+  # next to nothing
+
+  def __init__(self, enabled=False, window=1024):
+    self.enabled = enabled
+    self.window = window
+    self.timings = collections.defaultdict(lambda: Histogram(self.window))
+    self.values = collections.defaultdict(lambda: Histogram(self.window))
+
+  def start(self):
+    if not self.enabled:
+      return 0.
+    return time.perf_counter()
+
+  def lap(self, phase, start):
+    # records the time since start under phase, returns the current time
+    if not self.enabled:
+      return 0.
+    now = time.perf_counter()
+    self.timings[phase].add(now - start)
+    return now
+
+  def record(self, name, value):
+    # records any other per tick value (eg., bytes sent)
+    if self.enabled:
+      self.values[name].add(value)
+
+def collect(game):
+  # everything worth knowing about a running game, as a json friendly dict
+  entity_counts = collections.Counter(type(e).__name__ for e in game.entities)
+  if game.bullets is not None:
+    entity_counts['BulletStore'] = len(game.bullets)
+  out = game.output
+  return {
+    'scheduler': game.scheduler.stats(),
+    'profiling': game.profiler.enabled,
+    'phases': {k: h.summary() for k, h in game.profiler.timings.items()},
+    'values': {k: h.summary() for k, h in game.profiler.values.items()},
+    'entities': dict(entity_counts),
+    'bullet_pool': game.bullet_pool.stats(),
+    'players': len(game.players),
+    'level': game.level,
+    'ring_overflows': game.ring.overflows if game.ring is not None else None,
+    'levels': game.levels.stats() if game.levels is not None else None,
+    'flow_fields': game.flow_fields.stats(),
+    'output': {
+      'sent': out.sent,
+      'dropped': out.dropped,
+      'disconnected': out.disconnected,
+      'bytes_queued': out.bytes_queued,
+      'backlog_errors': out.backlog_errors,
+    },
+    'clients': {
+      sid: {'queue_depth': len(c.pending), 'bytes_sent': c.bytes_sent}
+      for sid, c in out.clients.items()
+    },
+  }
+
+def prometheus(game, prefix='breadcrumbs'):
+  # the same data in the prometheus text exposition format
+  return format_prometheus([({}, collect(game))], prefix)
+
+def format_prometheus(collected, prefix='breadcrumbs'):
+  # collected is a list of (labels, output of collect), eg., one per shard.
+  # the labels are added to every sample of that output
+  families = {} # name -> (kind, help, samples)
+  for extra, m in collected:
+    add_metrics(m, extra, families)
+  lines = []
+  for name, (kind, help, samples) in families.items():
+    name = prefix + '_' + name
+    if help:
+      lines.append(f'# HELP {name} {help}')
+    lines.append(f'# TYPE {name} {kind}')
+    for suffix, labels, value in samples:
+      label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+      lines.append(f'{name}{suffix}{{{label_str}}} {value}' if label_str else f'{name}{suffix} {value}')
+  return '\n'.join(lines) + '\n'
+
+def add_metrics(m, extra, families):
+  # adds the samples of m (output of collect) to families, with extra labels
+
+  def metric(name, kind, samples, help=None):
+    family = families.setdefault(name, (kind, help, []))
+    family[2].extend((suffix, {**extra, **labels}, value) for suffix, labels, value in samples)
+
+  def summaries(name, label, hists, help):
+    samples = []
+    for key, s in hists.items():
+      samples += [
+        ('', {label: key, 'quantile': '0.5'}, s['p50']),
+        ('', {label: key, 'quantile': '0.99'}, s['p99']),
+        ('_sum', {label: key}, s['sum']),
+        ('_count', {label: key}, s['count']),
+      ]
+    metric(name, 'summary', samples, help)
+
+  s = m['scheduler']
+  metric('tps', 'gauge', [('', {}, s['tps'])], 'measured simulation ticks per second')
+  metric('sends_per_second', 'gauge', [('', {}, s['sends_per_second'])])
+  for key in ['steps', 'sends', 'overruns', 'catchup_steps', 'skipped']:
+    metric(key + '_total', 'counter', [('', {}, s[key])])
+  metric('max_lateness_seconds', 'gauge', [('', {}, s['max_lateness'])])
+  summaries('phase_seconds', 'phase', m['phases'], 'time spent per tick in each phase')
+  summaries('tick_value', 'name', m['values'], 'other per tick values')
+  metric('entities', 'gauge', [('', {'type': k}, v) for k, v in m['entities'].items()])
+  metric('bullet_pool_hits_total', 'counter', [('', {}, m['bullet_pool']['hits'])],
+    'bullets reused from the pool')
+  metric('bullet_pool_misses_total', 'counter', [('', {}, m['bullet_pool']['misses'])],
+    'bullets allocated because the pool was empty')
+  metric('bullet_pool_free', 'gauge', [('', {}, m['bullet_pool']['free'])])
+  metric('players', 'gauge', [('', {}, m['players'])])
+  metric('level', 'gauge', [('', {}, m['level'])], 'levels descended')
+  if m['levels'] is not None:
+    metric('levels_ready', 'gauge', [('', {}, m['levels']['ready'])],
+      'levels generated ahead and ready to descend to')
+  f = m['flow_fields']
+  metric('flow_fields', 'gauge', [('', {}, f['fields'])], 'cached enemy flow fields')
+  metric('flow_field_misses_total', 'counter', [('', {}, f['misses'])],
+    'flow fields computed (counts restart every level)')
+  metric('flow_field_hits_total', 'counter', [('', {}, f['hits'])])
+  metric('messages_sent_total', 'counter', [('', {}, m['output']['sent'])])
+  metric('messages_dropped_total', 'counter', [('', {}, m['output']['dropped'])])
+  metric('clients_disconnected_total', 'counter', [('', {}, m['output']['disconnected'])])
+  metric('bytes_queued_total', 'counter', [('', {}, m['output']['bytes_queued'])])
+  metric('output_backlog_errors_total', 'counter', [('', {}, m['output']['backlog_errors'])],
+    'failed reads of engine.io send queues (backpressure is off while these happen)')
+  metric('client_bytes_sent_total', 'counter',
+    [('', {'client': sid}, c['bytes_sent']) for sid, c in m['clients'].items()])
+  metric('client_queue_depth', 'gauge',
+    [('', {'client': sid}, c['queue_depth']) for sid, c in m['clients'].items()])
@@ -0,0 +1,191 @@
+import asyncio as aio
+import collections
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+class Client:
+
+  def __init__(self, sid=None):
+    self.sid = sid
+    self.eio_sid = None
+    # key -> (encoded packets, size), in send order
+    self.pending = collections.OrderedDict()
+    self.ready = aio.Event()
+    self.task = None
+    # unique keys for messages that can't be dropped
+    self.next_reliable_key = 0
+    self.bytes_sent = 0
+
+class Sink:
+  # where Game sends everything meant for the clients, addressed by client id
+  # (the player id). this base sink serializes and counts messages like the
+  # real output stage does, but doesn't deliver them anywhere, which is all
+  # headless runs and benchmarks need
+
+  packet_class = packet.Packet
+
+  def __init__(self):
+    self.clients = {}
+    # counters
+    self.sent = 0
+    self.dropped = 0
+    self.disconnected = 0
+    self.bytes_queued = 0
+    self.backlog_errors = 0 # failed looks at a transport's send queue
+
+  def add_client(self, client_id, sid=None):
+    self.clients[client_id] = Client(sid)
+
+  def remove_client(self, client_id):
+    self.clients.pop(client_id, None)
+
+  def encode(self, event, data):
+    # serialize a socket.io event once, into the engine.io packets to send
+    encoded = self.packet_class(packet.EVENT, namespace='/', data=[event, data]).encode()
+    if not isinstance(encoded, list):
+      encoded = [encoded]
+    return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+  def size(self, packets):
+    # payload bytes of encoded packets (characters, for text packets)
+    return sum(len(p.data) for p in packets)
+
+  def send(self, client_id, key, packets, droppable=True, size=None):
+    # returns the number of bytes sent
+    client = self.clients.get(client_id)
+    if client is None:
+      return 0
+    if size is None:
+      size = self.size(packets)
+    self.sent += 1
+    self.bytes_queued += size
+    client.bytes_sent += size
+    return size
+
+  def broadcast(self, key, packets, droppable=True):
+    size = self.size(packets)
+    return sum(self.send(c, key, packets, droppable, size) for c in list(self.clients))
+
+  def flush(self):
+    # called at the end of every send, for sinks that batch messages
+    pass
+
+  def world_changed(self, level, world):
+    # called when the game moves to another world
+    pass
+
+  def queue_depths(self):
+    return {client_id: len(client.pending) for client_id, client in self.clients.items()}
+
+class Output(Sink):
+  # output stage between the simulation and socket.io.
+  # every payload is serialized once, no matter how many clients it goes to,
+  # and pushed onto bounded per client queues. each queue is drained by its own
+  # task, so the tick loop never waits on the network. while a client's
+  # transport is still busy, newer snapshots replace the stale ones waiting
+  # in its queue instead of piling up behind them
+
+  def __init__(self, sio, max_queue=8, poll_interval=0.005):
+    super().__init__()
+    self.sio = sio
+    self.packet_class = sio.packet_class
+    self.max_queue = max_queue
+    self.poll_interval = poll_interval
+
+  def add_client(self, client_id, sid=None):
+    client = Client(sid)
+    client.task = aio.get_event_loop().create_task(self.drain(client_id, client))
+    self.clients[client_id] = client
+
+  def remove_client(self, client_id):
+    client = self.clients.pop(client_id, None)
+    if client is not None:
+      client.task.cancel()
+
+  def kick(self, client_id):
+    # stop sending to the client and close its connection
+    client = self.clients.get(client_id)
+    if client is not None:
+      self.remove_client(client_id)
+      aio.get_event_loop().create_task(self.sio.disconnect(client.sid))
+
+  def send(self, client_id, key, packets, droppable=True, size=None):
+    # droppable messages with the same key replace each other (eg., snapshots),
+    # the rest are always delivered. returns the number of bytes queued
+    client = self.clients.get(client_id)
+    if client is None:
+      return 0
+    if size is None:
+      size = self.size(packets)
+    pending = client.pending
+    if droppable:
+      if pending.pop(key, None) is not None:
+        self.dropped += 1
+    else:
+      key = (key, client.next_reliable_key)
+      client.next_reliable_key += 1
+    if len(pending) >= self.max_queue:
+      # make space by dropping the oldest droppable message. never a pending
+      # keyframe, the deltas queued after it are against it (see
+      # snapshot.send_key) and the client couldn't decode anything until the
+      # next periodic one
+      for old_key in pending:
+        if not isinstance(old_key, tuple) and old_key != 'keyframe':
+          del pending[old_key]
+          self.dropped += 1
+          break
+      else:
+        # nothing droppable queued, the client can't keep up at all
+        self.disconnected += 1
+        self.kick(client_id)
+        return 0
+    pending[key] = (packets, size)
+    self.bytes_queued += size
+    client.ready.set()
+    return size
+
+  def backlog(self, client):
+    # number of packets socket.io has accepted but not yet written. engine.io
+    # has no public api for this, so it relies on its internals
+    # (AsyncServer._get_socket and the socket's queue, as of python-engineio
+    # 4.x, checked against 4.14). if those change, backpressure stops working
+    # and backlog_errors (output_backlog_errors_total in metrics) counts up
+    try:
+      socket = self.sio.eio._get_socket(client.eio_sid)
+    except KeyError:
+      # unknown or closed session, the client is on its way out
+      return 0
+    try:
+      return socket.queue.qsize()
+    except Exception as e:
+      if not self.backlog_errors:
+        print(f'output: cannot read the engine.io send queue, no backpressure ({e!r})')
+      self.backlog_errors += 1
+      return 0
+
+  async def drain(self, client_id, client):
+    while True:
+      await client.ready.wait()
+      if client.eio_sid is None:
+        client.eio_sid = self.sio.manager.eio_sid_from_sid(client.sid, '/')
+      while client.pending:
+        # let the transport catch up before handing it anything else, until
+        # then newer messages can still replace stale ones in our queue
+        while self.backlog(client):
+          await aio.sleep(self.poll_interval)
+        if not client.pending:
+          break
+        _, (packets, size) = client.pending.popitem(last=False)
+        try:
+          for p in packets:
+            await self.sio.eio.send_packet(client.eio_sid, p)
+        except Exception:
+          # client went away. nothing drains its queue any more, so stop
+          # queueing for it (disconnect handling would remove it too)
+          if self.clients.get(client_id) is client:
+            del self.clients[client_id]
+          return
+        self.sent += 1
+        client.bytes_sent += size
+      client.ready.clear()
@@ -8,6 +8,24 @@ def main():
   config = edict({
     'server_port': 6942,
     'tps': 60,
+    'send_rate': 20, # snapshots per second, at most tps
+    'interp_delay': 0.1, # seconds clients render behind the newest snapshot
+    'max_catchup_steps': 4, # most ticks simulated at once after falling behind
+    'tick_spin': 0., # seconds before each tick spent busy waiting instead of sleeping
+    'profile': False, # per phase timings, served on /metrics
+    'bullet_store': True, # keep ordinary bullets in numpy arrays
+    'keyframe_interval': 120, # ticks between full entity snapshots
+    'interest_radius': 20., # only send entities this close to a player
+    'send_queue_size': 8, # max messages waiting to be sent to one client
+    'chunk_size': 16, # tiles per side of the chunks the map is streamed in
+    'chunk_radius': 24., # players are sent the map within this many tiles
+    'levels_ahead': 2, # levels generated in the background (0 to stay on one level)
+    'level_workers': 1, # processes generating levels
+    'shards': 0, # game processes to spread players over (0 runs the game in this one)
+    'shard_transport': 'pipe', # or 'ring', to encode in this process from shared memory
+    'world_cache': 'levels', # directory of pregenerated levels (None to always generate)
+    'enemies_per_level': 40, # enemies spawned on every level
+    'enemy_sight': 24, # enemies chase players at most this many steps away
   });
   print("Config: ", config)
   print("Starting server")
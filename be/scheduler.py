@@ -0,0 +1,90 @@
+import asyncio as aio
+import time
+
+class FixedStepScheduler:
+  # runs step(dt) at a fixed rate and send() at a (possibly lower) network rate.
+  # deadlines are absolute multiples of dt from the start, so timing errors
+  # never accumulate. when a wakeup is late, the missed steps are caught up,
+  # but at most max_steps per wakeup, anything beyond that is skipped
+
+  def __init__(
+      self, step, send, tps, send_rate=None,
+      max_steps=4, spin=0., clock=time.perf_counter,
+  ):
+    self.step = step
+    self.send = send
+    self.dt = 1. / tps
+    # sends per step
+    self.send_ratio = min((send_rate or tps) / tps, 1.)
+    self.max_steps = max_steps
+    # seconds at the end of every wait spent yielding to the event loop
+    # instead of sleeping, since sleep() can wake up more than a millisecond
+    # late. that is tighter timing for a busy cpu on every tick (in every
+    # shard), so off unless asked for
+    self.spin = spin
+    self.clock = clock
+    # counters
+    self.steps = 0
+    self.sends = 0
+    self.overruns = 0 # wakeups whose work took longer than one step
+    self.catchup_steps = 0 # extra steps run to catch up after a late wakeup
+    self.skipped = 0 # steps dropped because we were too far behind
+    self.max_lateness = 0. # seconds, worst wakeup lateness seen
+    self.start_time = None
+
+  def stats(self):
+    elapsed = self.clock() - self.start_time if self.start_time is not None else 0.
+    return {
+      'tps': self.steps / elapsed if elapsed > 0 else 0.,
+      'sends_per_second': self.sends / elapsed if elapsed > 0 else 0.,
+      'steps': self.steps,
+      'sends': self.sends,
+      'overruns': self.overruns,
+      'catchup_steps': self.catchup_steps,
+      'skipped': self.skipped,
+      'max_lateness': self.max_lateness,
+    }
+
+  async def sleep_until(self, deadline):
+    delay = deadline - self.clock() - self.spin
+    if delay > 0:
+      await aio.sleep(delay)
+    while self.clock() < deadline:
+      await aio.sleep(0)
+
+  async def run(self):
+    clock = self.clock
+    dt = self.dt
+    self.start_time = clock()
+    next_step = self.start_time
+    send_credit = 1. # send on the very first step
+
+    while 1:
+      now = wakeup = clock()
+      self.max_lateness = max(self.max_lateness, now - next_step)
+
+      # run every step that is due, up to max_steps
+      steps = 0
+      while now >= next_step and steps < self.max_steps:
+        self.step(dt)
+        steps += 1
+        next_step += dt
+        send_credit = min(send_credit + self.send_ratio, 1. + self.send_ratio)
+        now = clock()
+      self.steps += steps
+      self.catchup_steps += max(steps - 1, 0)
+      if now >= next_step:
+        # still behind, give up on the missed steps
+        missed = int((now - next_step) / dt) + 1
+        self.skipped += missed
+        next_step += missed * dt
+
+      # only send the latest state, never catch up on sends
+      if steps and send_credit >= 1.:
+        self.send()
+        self.sends += 1
+        send_credit -= 1.
+
+      if clock() - wakeup > dt:
+        self.overruns += 1
+      await self.sleep_until(next_step)
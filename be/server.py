@@ -4,6 +4,9 @@ import socketio
 from aiohttp import web
 
 import game as ge # should be game_engine?
+import metrics
+import output
+import shards
 
 sio = socketio.AsyncServer(cors_allowed_origins='*')
 app = web.Application()
@@ -17,23 +20,67 @@ def connect(sid, environ):
   print("connect ", sid)
   player_id_map[sid] = len(player_id_map)
   player_id_map_inv.append(sid)
+  # may refuse the connection (if no shard is left), so nothing about the
+  # client is set up before it
   game.new_player(player_id_map[sid])
+  game.output.add_client(player_id_map[sid], sid)
+  # what the client needs to know to play back snapshots smoothly
+  game.output.send(
+    player_id_map[sid], 'clock', game.output.encode('clock', clock), droppable=False,
+  )
 
-@sio.event
+@sio.on('input')
 async def update_keys(sid, data):
-  game.update_player_keys(player_id_map[sid], data)
+  # [seq, mask of the held keys]
+  if isinstance(data, list) and len(data) == 2 and all(type(v) is int for v in data):
+    seq, mask = data
+    game.update_player_keys(player_id_map[sid], mask, seq)
+
+@sio.event
+async def ack(sid, tick):
+  if isinstance(tick, int):
+    game.ack_snapshot(player_id_map[sid], tick)
 
 @sio.event
 def disconnect(sid):
   print("disconnect", sid)
+  game.output.remove_client(player_id_map[sid])
   game.remove_player(player_id_map[sid])
 
+async def metrics_json(request):
+  if isinstance(game, shards.ShardRouter):
+    return web.json_response(game.collect())
+  return web.json_response(metrics.collect(game))
+
+async def metrics_prometheus(request):
+  if isinstance(game, shards.ShardRouter):
+    return web.Response(text=game.prometheus(), content_type='text/plain')
+  return web.Response(text=metrics.prometheus(game), content_type='text/plain')
+
+app.router.add_get('/metrics', metrics_prometheus)
+app.router.add_get('/metrics.json', metrics_json)
+
 def run(config):
-  global game # spaghetti
-  game = ge.Game(config)
+  global game, clock # spaghetti
+  # clients render snapshots interp_delay seconds late, so they always have
+  # one on each side of what they render (see fe/app.js)
+  clock = {
+    'tps': config.tps,
+    'send_rate': min(config.get('send_rate') or config.tps, config.tps),
+    'interp_delay': config.get('interp_delay', 0.1),
+  }
+  out = output.Output(sio, config.get('send_queue_size', 8))
+  if config.get('shards'):
+    # the games run in their own processes, this one only does networking
+    game = shards.ShardRouter(config, out, config.shards)
+  else:
+    game = ge.Game(config, out)
 
   loop = aio.get_event_loop()
   loop.create_task(game.game_loop())
 
-  web.run_app(app, port=config.server_port, loop=loop)
+  try:
+    web.run_app(app, port=config.server_port, loop=loop)
+  finally:
+    game.close()
 
@@ -0,0 +1,399 @@
+import asyncio as aio
+import multiprocessing
+
+import numpy as np
+import socketio
+
+import chunks
+import game as ge
+import metrics
+import output
+import snapring
+import snapshot
+import spatial
+
+# many matches at once, one per core: every shard is a process running its
+# own Game and tick loop. the front process (server.py) keeps all socket.io
+# connections, places each new player on the shard with the fewest players,
+# and passes messages between the two over a pipe per shard
+#
+# what the clients are sent is made in one of two ways (shard_transport):
+#   pipe: shards encode everything themselves and send it over the pipe
+#   ring: shards only simulate and publish their state into a snapshot ring
+#         in shared memory (see snapring.py), the front does the per client
+#         encoding. the simulation then never waits on networking, even with
+#         a single shard
+#
+# front -> shard: ('join', player id), ('leave', player id),
+#                 ('keys', player id, key mask, seq), ('ack', player id, tick)
+#                 (acks stay in the front with the ring transport)
+# shard -> front: ('out', [(client id or None for all, key, (event, data), droppable)]),
+#                 once per send with the pipe transport, ('world', (level, World))
+#                 with the ring transport, and ('metrics', metrics.collect output)
+#                 every so often
+
+class PipeSink(output.Sink):
+  # output sink of a shard. messages are handed to the front, which encodes
+  # and sends them, everything from one send goes over in one batch
+
+  def __init__(self, conn):
+    super().__init__()
+    self.conn = conn
+    self.batch = []
+
+  def encode(self, event, data):
+    return (event, data)
+
+  def size(self, packets):
+    # only the front knows the encoded size of anything but binary payloads
+    _, data = packets
+    return len(data) if isinstance(data, (bytes, bytearray)) else 0
+
+  def send(self, client_id, key, packets, droppable=True, size=None):
+    if client_id not in self.clients:
+      return 0
+    self.batch.append((client_id, key, packets, droppable))
+    return super().send(client_id, key, packets, droppable, size)
+
+  def broadcast(self, key, packets, droppable=True):
+    # the front sends it to every player of the shard
+    self.batch.append((None, key, packets, droppable))
+    size = self.size(packets)
+    for client in self.clients.values():
+      client.bytes_sent += size
+    self.sent += len(self.clients)
+    self.bytes_queued += size * len(self.clients)
+    return size * len(self.clients)
+
+  def flush(self):
+    if self.batch:
+      self.conn.send(('out', self.batch))
+      self.batch = []
+
+class RingSink(output.Sink):
+  # output sink of a shard with the ring transport. the front makes every
+  # message from the ring, this only tells it which world the game is in
+
+  def __init__(self, conn):
+    super().__init__()
+    self.conn = conn
+
+  def world_changed(self, level, world):
+    self.conn.send(('world', (level, world)))
+
+def handle(game, message):
+  # a message from the front
+  kind, *args = message
+  if kind == 'join':
+    player_id, = args
+    game.output.add_client(player_id)
+    game.new_player(player_id)
+  elif kind == 'leave':
+    player_id, = args
+    game.output.remove_client(player_id)
+    game.remove_player(player_id)
+  elif kind == 'keys':
+    game.update_player_keys(*args)
+  elif kind == 'ack':
+    game.ack_snapshot(*args)
+
+async def report(game, conn, interval):
+  while True:
+    await aio.sleep(interval)
+    conn.send(('metrics', metrics.collect(game)))
+
+def run_shard(index, config, conn, ring_spec=None):
+  # entry point of a shard process, runs until the front goes away
+  if ring_spec is None:
+    game = ge.Game(config, PipeSink(conn))
+  else:
+    game = ge.Game(config, RingSink(conn), snapring.SnapshotRing(create=False, **ring_spec))
+  loop = aio.new_event_loop()
+  aio.set_event_loop(loop)
+  main = loop.create_task(game.game_loop())
+
+  def receive():
+    try:
+      while conn.poll():
+        handle(game, conn.recv())
+    except (EOFError, OSError):
+      main.cancel()
+
+  loop.add_reader(conn.fileno(), receive)
+  loop.create_task(report(game, conn, config.get('shard_metrics_interval', 1.)))
+  try:
+    loop.run_until_complete(main)
+  except aio.CancelledError:
+    pass
+  finally:
+    game.close()
+
+class Relay:
+  # the front's half of a shard with the ring transport: does what Game.send
+  # does, from the latest snapshot in the ring
+
+  def __init__(self, config, output, ring):
+    self.config = config
+    self.output = output
+    self.ring = ring
+    self.interest_radius = config.get('interest_radius', 20.)
+    self.deltas = snapshot.DeltaEncoder(config.get('keyframe_interval', 120))
+    # the world the shard is in, from its last ('world', ...) message
+    self.level = None
+    self.chunks = None
+    self.seq = 0 # last snapshot sent
+    # counters
+    self.sends = 0
+    self.torn = 0 # snapshots overwritten while they were being encoded
+
+  def set_world(self, level, world, players):
+    if self.level is not None:
+      # clients drop the map they have, the chunks of the new one follow
+      packets = self.output.encode('level', level)
+      for player_id in players:
+        self.output.send(player_id, 'level', packets, droppable=False)
+    self.level = level
+    self.chunks = chunks.ChunkStreamer(
+      world, self.config.get('chunk_size', 16), self.config.get('chunk_radius', 24.),
+    )
+
+  def forget(self, player_id):
+    self.deltas.forget(player_id)
+    if self.chunks is not None:
+      self.chunks.forget(player_id)
+
+  def relay(self, players):
+    # sends the latest snapshot to players (the ids of the shard's players),
+    # unless it was sent already
+    slot = self.ring.read()
+    if slot is None or slot.seq == self.seq:
+      return
+    self.seq = slot.seq
+    # same as Game.send, except tracked entities are marked in the records
+    out = self.output
+    records = slot.records
+    snap = slot.snapshot()
+    rows = [row for row in slot.players.tolist() if row[0] in players]
+    selves, found = snap.find([entity_id for _, entity_id, _ in rows])
+    xs = records['x'][selves].tolist()
+    ys = records['y'][selves].tolist()
+
+    if self.chunks is not None and slot.level == self.level:
+      for (player_id, _, _), f, x, y in zip(rows, found.tolist(), xs, ys):
+        payload = self.chunks.encode(player_id, x, y) if f else None
+        if payload is not None:
+          out.send(player_id, 'world', out.encode('world', payload), droppable=False)
+
+    self.deltas.begin_tick()
+    if self.interest_radius is None:
+      # the views are kept as delta bases, so they can't point into the ring
+      full = snapshot.Snapshot(snap.tick, snap.ids.copy(), snap.states.copy())
+    else:
+      index = spatial.GridIndex(
+        snap.states['x'], snap.states['y'], snap.states['w'], snap.states['h'],
+      )
+      r = self.interest_radius
+    payloads = []
+    for (player_id, entity_id, input_seq), f, x, y in zip(rows, found.tolist(), xs, ys):
+      if self.interest_radius is None:
+        view = full
+      else:
+        idx = index.query(x - r, y - r, x + r, y + r) if f else np.zeros(0, dtype=np.intp)
+        tracked = (records['tracker'] == entity_id).nonzero()[0]
+        if len(tracked):
+          idx = np.union1d(idx, tracked)
+        view = snap.select(idx)
+      payloads.append((player_id, self.deltas.encode(player_id, view, entity_id, input_seq)))
+
+    if not self.ring.valid(slot):
+      # the shard lapped us while we were reading, all of this may be garbage
+      self.torn += 1
+      for player_id, _ in payloads:
+        self.deltas.forget(player_id)
+      return
+    for player_id, payload in payloads:
+      out.send(player_id, snapshot.send_key(payload), out.encode('entities', payload))
+    self.sends += 1
+
+  def stats(self):
+    return {
+      'level': self.level,
+      'sends': self.sends,
+      'torn': self.torn,
+    }
+
+class Shard:
+  # the front's end of a shard
+
+  def __init__(self, index, process, conn, relay=None):
+    self.index = index
+    self.process = process
+    self.conn = conn
+    self.relay = relay
+    self.alive = True
+    self.players = set()
+    self.metrics = None # last ones it reported
+
+class ShardRouter:
+  # runs in the front process and stands in for the Game there: server.py
+  # calls the same methods on it, and it passes them on to the right shard.
+  # messages from the shards go out through the front's Output
+
+  def __init__(self, config, output, shards):
+    self.output = output
+    self.poll_interval = config.get('ring_poll_interval', 0.002)
+    # spawned, so shards don't inherit the front's event loop and sockets
+    ctx = multiprocessing.get_context('spawn')
+    self.shards = []
+    for index in range(shards):
+      conn, child_conn = ctx.Pipe()
+      relay = ring_spec = None
+      if config.get('shard_transport', 'pipe') == 'ring':
+        ring = snapring.SnapshotRing(
+          slots=config.get('ring_slots', 8),
+          max_entities=config.get('ring_entities', 16384),
+          max_players=config.get('ring_players', 256),
+        )
+        relay = Relay(config, output, ring)
+        ring_spec = ring.spec()
+      process = ctx.Process(
+        target=run_shard, args=(index, config, child_conn, ring_spec), name=f'shard{index}',
+      )
+      process.start()
+      child_conn.close()
+      self.shards.append(Shard(index, process, conn, relay))
+    self.placement = {} # player id -> Shard
+
+  def place(self):
+    # balance players across shards (and so across cores). None if every
+    # shard is gone
+    return min((s for s in self.shards if s.alive), key=lambda s: len(s.players), default=None)
+
+  def send(self, shard, message):
+    if not shard.alive:
+      return
+    try:
+      shard.conn.send(message)
+    except OSError:
+      self.lost(shard)
+
+  def new_player(self, player_id):
+    shard = self.place()
+    if shard is None:
+      # turns the connection down (see server.connect)
+      raise socketio.exceptions.ConnectionRefusedError('no game is running')
+    shard.players.add(player_id)
+    self.placement[player_id] = shard
+    self.send(shard, ('join', player_id))
+
+  def remove_player(self, player_id):
+    shard = self.placement.pop(player_id, None)
+    if shard is not None:
+      shard.players.discard(player_id)
+      self.send(shard, ('leave', player_id))
+      if shard.relay is not None:
+        shard.relay.forget(player_id)
+
+  def update_player_keys(self, player_id, mask, seq=None):
+    # messages from players that aren't placed (any more) are ignored
+    shard = self.placement.get(player_id)
+    if shard is not None:
+      self.send(shard, ('keys', player_id, mask, seq))
+
+  def ack_snapshot(self, player_id, tick):
+    shard = self.placement.get(player_id)
+    if shard is None:
+      return
+    if shard.relay is not None:
+      shard.relay.deltas.ack(player_id, tick)
+    else:
+      self.send(shard, ('ack', player_id, tick))
+
+  def receive(self, shard):
+    out = self.output
+    try:
+      while shard.conn.poll():
+        kind, data = shard.conn.recv()
+        if kind == 'metrics':
+          shard.metrics = data
+          continue
+        if kind == 'world':
+          shard.relay.set_world(*data, shard.players)
+          continue
+        for client_id, key, (event, payload), droppable in data:
+          packets = out.encode(event, payload)
+          if client_id is None:
+            size = out.size(packets)
+            for player_id in list(shard.players):
+              out.send(player_id, key, packets, droppable, size)
+          else:
+            out.send(client_id, key, packets, droppable)
+    except (EOFError, OSError):
+      self.lost(shard)
+
+  def lost(self, shard):
+    # the shard died, its players can't play any more. disconnect them rather
+    # than leave them staring at a frozen game, they can reconnect to a live one
+    if not shard.alive:
+      return
+    print(f'shard {shard.index} exited with {len(shard.players)} players')
+    shard.alive = False
+    aio.get_event_loop().remove_reader(shard.conn.fileno())
+    for player_id in shard.players:
+      self.placement.pop(player_id, None)
+      if shard.relay is not None:
+        shard.relay.forget(player_id)
+      self.output.kick(player_id)
+    shard.players.clear()
+
+  async def game_loop(self):
+    loop = aio.get_event_loop()
+    for shard in self.shards:
+      loop.add_reader(shard.conn.fileno(), self.receive, shard)
+    if any(s.relay is not None for s in self.shards):
+      loop.create_task(self.relay_loop())
+    await aio.gather(*(loop.run_in_executor(None, s.process.join) for s in self.shards))
+
+  async def relay_loop(self):
+    # shards don't tell us when they published something, check every so often
+    while True:
+      await aio.sleep(self.poll_interval)
+      for shard in self.shards:
+        if shard.relay is not None and shard.alive:
+          shard.relay.relay(shard.players)
+
+  def collect(self):
+    out = self.output
+    return {
+      'shards': [
+        {
+          'alive': s.alive,
+          'players': len(s.players),
+          'relay': s.relay.stats() if s.relay is not None else None,
+          'metrics': s.metrics,
+        }
+        for s in self.shards
+      ],
+      'output': {
+        'sent': out.sent,
+        'dropped': out.dropped,
+        'disconnected': out.disconnected,
+        'bytes_queued': out.bytes_queued,
+        'backlog_errors': out.backlog_errors,
+      },
+    }
+
+  def prometheus(self):
+    return metrics.format_prometheus([
+      ({'shard': s.index}, s.metrics) for s in self.shards if s.metrics is not None
+    ])
+
+  def close(self):
+    for shard in self.shards:
+      shard.conn.close()
+    for shard in self.shards:
+      shard.process.join(5)
+      if shard.process.is_alive():
+        shard.process.terminate()
+      if shard.relay is not None:
+        shard.relay.ring.close(unlink=True)
@@ -0,0 +1,137 @@
+import struct
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import snapshot
+
+# ring of entity snapshots in shared memory. a simulation process writes one
+# every send, a networking process reads the latest and does the encoding and
+# sending (see shards.py). the reader works on the records where they are,
+# nothing is copied or pickled between the two
+#
+# layout: u64 seq of the latest complete snapshot (0 before the first one),
+# then `slots` slots, snapshot seq going in slot seq % slots. each slot is
+#   header:  u64 seq (0 while it is being written), u32 tick, u32 level,
+#            u32 #records, u32 #players
+#   records: max_entities RECORDs, sorted by id
+#   players: max_players PLAYERs
+# a slot is only rewritten `slots` snapshots later, readers check its seq
+# again after using it to make sure that didn't happen in the meantime
+
+LATEST = struct.Struct('<Q')
+SLOT_HEADER = struct.Struct('<QIIII')
+
+# state of one entity, the snapshot.STATE fields plus what else the
+# networking side needs
+RECORD = np.dtype([
+  ('id', '<u4'),
+  ('x', '<f4'),
+  ('y', '<f4'),
+  ('w', '<f4'),
+  ('h', '<f4'),
+  ('sprite_id', '<u2'),
+  ('pad', '<u2'),
+  ('hp', '<f4'),
+  ('max_hp', '<f4'),
+  ('vx', '<f4'),
+  ('vy', '<f4'),
+  ('tracker', '<u4'), # entity id of the player tracking this entity, or 0
+])
+
+PLAYER = np.dtype([
+  ('player_id', '<u4'),
+  ('entity_id', '<u4'),
+  ('input_seq', '<u4'),
+])
+
+class Slot:
+  # one snapshot read from the ring, the arrays point into shared memory
+
+  def __init__(self, seq, tick, level, records, players):
+    self.seq = seq
+    self.tick = tick
+    self.level = level
+    self.records = records
+    self.players = players
+
+  def snapshot(self):
+    # the records as a snapshot.Snapshot, without copying them
+    return snapshot.Snapshot(self.tick, self.records['id'], self.records[list(snapshot.FIELDS)])
+
+class SnapshotRing:
+
+  def __init__(self, name=None, slots=8, max_entities=16384, max_players=256, create=True):
+    self.slots = slots
+    self.max_entities = max_entities
+    self.max_players = max_players
+    self.slot_size = (
+      SLOT_HEADER.size + max_entities * RECORD.itemsize + max_players * PLAYER.itemsize
+    )
+    size = LATEST.size + slots * self.slot_size
+    self.shm = shared_memory.SharedMemory(name, create, size if create else 0)
+    self.name = self.shm.name
+    self.buf = self.shm.buf
+    if create:
+      LATEST.pack_into(self.buf, 0, 0)
+    # writer state
+    self.written = LATEST.unpack_from(self.buf, 0)[0]
+    self.overflows = 0 # snapshots that didn't fit and were cut short
+
+  def spec(self):
+    # arguments to attach to this ring from another process
+    return {
+      'name': self.name, 'slots': self.slots,
+      'max_entities': self.max_entities, 'max_players': self.max_players,
+    }
+
+  def offset(self, seq):
+    return LATEST.size + (seq % self.slots) * self.slot_size
+
+  def arrays(self, seq):
+    # records and players of the slot of seq, at full capacity
+    offset = self.offset(seq) + SLOT_HEADER.size
+    records = np.ndarray(self.max_entities, RECORD, self.buf, offset)
+    offset += self.max_entities * RECORD.itemsize
+    players = np.ndarray(self.max_players, PLAYER, self.buf, offset)
+    return records, players
+
+  def begin(self):
+    # start writing the next snapshot, returns the arrays to fill in
+    seq = self.written + 1
+    SLOT_HEADER.pack_into(self.buf, self.offset(seq), 0, 0, 0, 0, 0)
+    return self.arrays(seq)
+
+  def commit(self, tick, level, num_records, num_players):
+    # finish the snapshot started with begin, readers can see it from now on
+    seq = self.written + 1
+    SLOT_HEADER.pack_into(self.buf, self.offset(seq), seq, tick, level, num_records, num_players)
+    LATEST.pack_into(self.buf, 0, seq)
+    self.written = seq
+
+  def read(self):
+    # the latest snapshot, or None if there is none (or it is being
+    # overwritten, if the reader fell a whole ring behind)
+    seq = LATEST.unpack_from(self.buf, 0)[0]
+    if not seq:
+      return None
+    slot_seq, tick, level, num_records, num_players = SLOT_HEADER.unpack_from(self.buf, self.offset(seq))
+    if slot_seq != seq:
+      return None
+    records, players = self.arrays(seq)
+    return Slot(seq, tick, level, records[:num_records], players[:num_players])
+
+  def valid(self, slot):
+    # whether the slot still holds the snapshot it was read with
+    return SLOT_HEADER.unpack_from(self.buf, self.offset(slot.seq))[0] == slot.seq
+
+  def close(self, unlink=False):
+    # views into the buffer have to be gone before it can be closed
+    self.buf = None
+    try:
+      self.shm.close()
+    except BufferError:
+      # still in use somewhere, it goes away with the process
+      pass
+    if unlink:
+      self.shm.unlink()
@@ -0,0 +1,220 @@
+import struct
+
+import numpy as np
+
+# binary, delta compressed entity snapshots, sent as socket.io binary
+# attachments (decoded by applySnapshot in fe/app.js, keep the two in sync)
+#
+# every message is a delta against a snapshot (the base) the client has
+# acknowledged, or a keyframe containing everything
+#
+# header:
+#   u16 version, u16 flags, u32 tick, u32 base tick, u32 self id,
+#   u32 input seq (of the last key update received from the recipient),
+#   u32 #spawned, u32 #despawned, u32 #changed
+# body:
+#   spawned:   #spawned full records (u32 id, f32 x, f32 y, f32 w, f32 h,
+#              u16 sprite_id, u16 padding, f32 hp, f32 max_hp, f32 vx, f32 vy)
+#   despawned: #despawned u32 ids
+#   changed:   #changed u32 ids, then #changed u16 field masks, then for every
+#              field in FIELDS order, the new values of the entities that
+#              have the field's bit set in their mask (in the same order)
+# all little endian
+
+VERSION = 5
+
+HEADER = struct.Struct('<HHIIIIIII')
+# the per recipient fields, self id and input seq
+RECIPIENT_OFFSET = 12
+
+# header flags
+FLAG_KEYFRAME = 1 # state is built from scratch, the base tick is meaningless
+
+# state of one entity, the bit of each field in the change mask is its index.
+# health rides along with the rest, so like everything else it is only sent
+# when it changed since the base (and with every keyframe). entities without
+# health have a max_hp of 0. the velocity (per second) lets clients carry
+# entities on between snapshots
+STATE = np.dtype([
+  ('x', '<f4'),
+  ('y', '<f4'),
+  ('w', '<f4'),
+  ('h', '<f4'),
+  ('sprite_id', '<u2'),
+  ('hp', '<f4'),
+  ('max_hp', '<f4'),
+  ('vx', '<f4'),
+  ('vy', '<f4'),
+])
+FIELDS = STATE.names
+
+SPAWN_RECORD = np.dtype([
+  ('id', '<u4'),
+  ('x', '<f4'),
+  ('y', '<f4'),
+  ('w', '<f4'),
+  ('h', '<f4'),
+  ('sprite_id', '<u2'),
+  ('pad', '<u2'),
+  ('hp', '<f4'),
+  ('max_hp', '<f4'),
+  ('vx', '<f4'),
+  ('vy', '<f4'),
+])
+
+class Snapshot:
+  # the state of a set of entities for one tick, sorted by entity id
+
+  def __init__(self, tick, ids, states):
+    self.tick = tick
+    self.ids = ids
+    self.states = states
+
+  @classmethod
+  def capture(cls, tick, entities, bullets=None):
+    # snapshot of every entity object and store bullet
+    entities = list(entities)
+    num_bullets = len(bullets) if bullets is not None else 0
+    n = len(entities)
+    ids = np.zeros(n + num_bullets, dtype=np.uint32)
+    states = np.zeros(n + num_bullets, dtype=STATE)
+
+    if n:
+      ids[:n] = [e.id for e in entities]
+      states[:n] = [
+        (e.x, e.y, e.w, e.h, e.sprite_id, e.hp, e.max_hp, e.vx, e.vy) for e in entities
+      ]
+    if num_bullets:
+      # bullets are already columns, copy them over directly
+      ids[n:] = bullets.id[:num_bullets]
+      states['x'][n:] = bullets.x[:num_bullets]
+      states['y'][n:] = bullets.y[:num_bullets]
+      states['w'][n:] = bullets.w[:num_bullets]
+      states['h'][n:] = bullets.h[:num_bullets]
+      states['sprite_id'][n:] = bullets.sprite_id[:num_bullets]
+      states['vx'][n:], states['vy'][n:] = bullets.velocities()
+
+    order = ids.argsort()
+    return cls(tick, ids[order], states[order])
+
+  def __len__(self):
+    return len(self.ids)
+
+  def select(self, idx):
+    # snapshot of a subset of the entities, idx has to be sorted
+    return Snapshot(self.tick, self.ids[idx], self.states[idx])
+
+  def find(self, ids):
+    # indices of the given entity ids, and a mask of which of them were found
+    ids = np.asarray(ids, dtype=np.uint32)
+    if not len(self.ids):
+      return np.zeros(len(ids), dtype=np.intp), np.zeros(len(ids), dtype=bool)
+    idx = np.searchsorted(self.ids, ids).clip(0, len(self.ids) - 1)
+    return idx, self.ids[idx] == ids
+
+def is_keyframe(payload):
+  return bool(struct.unpack_from('<H', payload, 2)[0] & FLAG_KEYFRAME)
+
+def send_key(payload):
+  # output queue key of a payload. deltas sent after a keyframe are against
+  # it, so it must not be replaced by them while it is waiting to be sent
+  return 'keyframe' if is_keyframe(payload) else 'entities'
+
+def encode_delta(cur, base=None):
+  # encodes cur as a delta against base, or as a keyframe if base is None.
+  # the self id and input seq are left as 0, patch them in per recipient
+  if base is None:
+    spawned = np.ones(len(cur), dtype=bool)
+    despawned = np.zeros(0, dtype=np.uint32)
+    changed = np.zeros(0, dtype=np.intp)
+    masks = np.zeros(0, dtype=np.uint16)
+  else:
+    in_base = np.isin(cur.ids, base.ids, assume_unique=True)
+    spawned = ~in_base
+    despawned = base.ids[~np.isin(base.ids, cur.ids, assume_unique=True)]
+    # line up the entities present in both
+    changed = in_base.nonzero()[0]
+    base_idx = np.searchsorted(base.ids, cur.ids[changed])
+    masks = np.zeros(len(changed), dtype=np.uint16)
+    for bit, field in enumerate(FIELDS):
+      masks |= (cur.states[field][changed] != base.states[field][base_idx]).astype(np.uint16) << bit
+    moved = masks != 0
+    changed = changed[moved]
+    masks = masks[moved]
+
+  spawn = np.zeros(int(spawned.sum()), dtype=SPAWN_RECORD)
+  spawn['id'] = cur.ids[spawned]
+  for field in FIELDS:
+    spawn[field] = cur.states[field][spawned]
+
+  buf = bytearray(HEADER.pack(
+    VERSION, FLAG_KEYFRAME if base is None else 0,
+    cur.tick, base.tick if base is not None else 0, 0, 0,
+    len(spawn), len(despawned), len(changed),
+  ))
+  buf += spawn.tobytes()
+  buf += despawned.astype('<u4').tobytes()
+  buf += cur.ids[changed].astype('<u4').tobytes()
+  buf += masks.astype('<u2').tobytes()
+  for bit, field in enumerate(FIELDS):
+    has_field = (masks >> bit) & 1 == 1
+    buf += cur.states[field][changed[has_field]].tobytes()
+  return buf
+
+class DeltaEncoder:
+  # keeps what was recently sent to every viewer and what they acknowledged,
+  # and encodes each viewer's view of the current tick as a delta against the
+  # last view they acknowledged. viewers sent the same view against the same
+  # base share the same encoded payload
+
+  def __init__(self, keyframe_interval=120, history_length=64):
+    self.keyframe_interval = keyframe_interval
+    self.history_length = history_length
+    self.history = {} # viewer -> {tick -> Snapshot sent to the viewer}
+    self.acked = {} # viewer -> last acknowledged tick
+    self.last_keyframe = {} # viewer -> tick of the last keyframe sent
+    self.cache = {} # (view, base or None) -> payload, for the current tick
+
+  def begin_tick(self):
+    self.cache.clear()
+
+  def ack(self, viewer, tick):
+    if tick in self.history.get(viewer, ()) and tick > self.acked.get(viewer, -1):
+      self.acked[viewer] = tick
+
+  def forget(self, viewer):
+    self.history.pop(viewer, None)
+    self.acked.pop(viewer, None)
+    self.last_keyframe.pop(viewer, None)
+
+  def encode(self, viewer, view, self_id=0, input_seq=0):
+    history = self.history.setdefault(viewer, {})
+    history[view.tick] = view
+    # sends can skip ticks, drop everything that fell out of the window except
+    # what the next delta may be encoded against
+    cutoff = view.tick - self.history_length
+    keep = (self.acked.get(viewer), self.last_keyframe.get(viewer))
+    for tick in [tick for tick in history if tick < cutoff and tick not in keep]:
+      del history[tick]
+
+    acked = self.acked.get(viewer)
+    last_keyframe = self.last_keyframe.get(viewer)
+    if acked is not None and last_keyframe is not None and acked < last_keyframe:
+      # clients drop everything from before a keyframe (see applySnapshot in
+      # fe/app.js), until they ack something newer deltas are against it
+      acked = last_keyframe
+    base = history.get(acked)
+    if (
+        base is None
+        or last_keyframe is None
+        or view.tick - last_keyframe >= self.keyframe_interval
+    ):
+      # nothing usable acknowledged, or time for a periodic keyframe
+      base = None
+      self.last_keyframe[viewer] = view.tick
+
+    buf = self.cache.get((view, base))
+    if buf is None:
+      buf = self.cache[(view, base)] = encode_delta(view, base)
+    struct.pack_into('<II', buf, RECIPIENT_OFFSET, self_id, input_seq)
+    return bytes(buf)
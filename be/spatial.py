@@ -0,0 +1,127 @@
+import math
+
+import numpy as np
+
+import aabb
+
+class SpatialHash:
+  # uniform grid broadphase. every item is bucketed into each cell its aabb
+  # covers, so only items that share a cell are ever tested against each other
+
+  def __init__(self, cell_size=2.):
+    self.cell_size = cell_size
+    self.inv_cell_size = 1. / cell_size
+    self.cells = {}
+
+  def cell_range(self, x, y, w, h):
+    # inclusive range of cells covered by the aabb
+    inv = self.inv_cell_size
+    return (
+      math.floor(x * inv), math.floor(y * inv),
+      math.floor((x + w) * inv), math.floor((y + h) * inv),
+    )
+
+  def clear(self):
+    self.cells.clear()
+
+  def insert(self, item, x, y, w, h):
+    ix0, iy0, ix1, iy1 = self.cell_range(x, y, w, h)
+    # keep the min cell of the item around, it is used to dedup pairs
+    entry = (item, ix0, iy0)
+    cells = self.cells
+    for ix in range(ix0, ix1 + 1):
+      for iy in range(iy0, iy1 + 1):
+        bucket = cells.get((ix, iy))
+        if bucket is None:
+          cells[(ix, iy)] = [entry]
+        else:
+          bucket.append(entry)
+
+  def rebuild(self, entities):
+    # entities need to have up to date aabbs
+    self.clear()
+    for e in entities:
+      self.insert(e, e.aabb_x, e.aabb_y, e.aabb_w, e.aabb_h)
+
+  def query(self, x, y, w, h):
+    # returns every item whose cells overlap the given aabb (may contain false
+    # positives, the caller is responsible for the narrow phase)
+    ix0, iy0, ix1, iy1 = self.cell_range(x, y, w, h)
+    found = set()
+    cells = self.cells
+    for ix in range(ix0, ix1 + 1):
+      for iy in range(iy0, iy1 + 1):
+        bucket = cells.get((ix, iy))
+        if bucket is not None:
+          found.update(entry[0] for entry in bucket)
+    return found
+
+  def pairs(self):
+    # yields every unordered pair of items sharing a cell exactly once.
+    # two items with overlapping cell ranges share many cells, but only one of
+    # them is the cell at the min corner of the overlap: report it there
+    for (cx, cy), bucket in self.cells.items():
+      n = len(bucket)
+      for i in range(n):
+        a, ax, ay = bucket[i]
+        for j in range(i + 1, n):
+          b, bx, by = bucket[j]
+          if (ax if ax > bx else bx) == cx and (ay if ay > by else by) == cy:
+            yield a, b
+
+  def colliding_pairs(self):
+    # narrow phase on top of pairs(). expects items to be entities
+    for a, b in self.pairs():
+      if aabb.intersect(
+          a.aabb_x, a.aabb_y, a.aabb_w, a.aabb_h,
+          b.aabb_x, b.aabb_y, b.aabb_w, b.aabb_h,
+      ):
+        yield a, b
+
+class GridIndex:
+  # static index over arrays of entity boxes (centre x, y and half sizes w, h,
+  # like entity.Entity), eg., all entities of one snapshot. it is built with a
+  # single sort, after which querying a box only touches the cells it covers.
+  # entities larger than the cells are kept aside and tested on every query
+
+  def __init__(self, x, y, w, h, cell_size=8.):
+    self.x = x
+    self.y = y
+    self.w = w
+    self.h = h
+    self.cell_size = cell_size
+
+    large = (w > cell_size) | (h > cell_size)
+    self.large = large.nonzero()[0]
+    small = (~large).nonzero()[0]
+    cx = np.floor(x[small] / cell_size).astype(np.int64)
+    cy = np.floor(y[small] / cell_size).astype(np.int64)
+    self.min_cx = cx.min() if len(small) else 0
+    self.min_cy = cy.min() if len(small) else 0
+    self.max_cx = cx.max() if len(small) else -1
+    self.stride = (cy.max() - self.min_cy + 1) if len(small) else 1
+    keys = (cx - self.min_cx) * self.stride + (cy - self.min_cy)
+    order = keys.argsort(kind='stable')
+    self.keys = keys[order]
+    self.items = small[order]
+
+  def query(self, x0, y0, x1, y1):
+    # sorted indices of the entities overlapping the box [x0, x1] x [y0, y1]
+    cs = self.cell_size
+    # small entities can stick out of their cell by up to a cell
+    cx0 = max(math.floor((x0 - cs) / cs) - self.min_cx, 0)
+    cx1 = min(math.floor((x1 + cs) / cs) - self.min_cx, self.max_cx - self.min_cx)
+    cy0 = max(math.floor((y0 - cs) / cs) - self.min_cy, 0)
+    cy1 = min(math.floor((y1 + cs) / cs) - self.min_cy, self.stride - 1)
+    candidates = [self.large]
+    if cx0 <= cx1 and cy0 <= cy1:
+      # every column of cells is one contiguous run of keys
+      rows = np.arange(cx0, cx1 + 1) * self.stride
+      lo = np.searchsorted(self.keys, rows + cy0, 'left')
+      hi = np.searchsorted(self.keys, rows + cy1, 'right')
+      candidates += [self.items[l:h] for l, h in zip(lo.tolist(), hi.tolist()) if l < h]
+    idx = np.concatenate(candidates)
+    # narrow phase
+    x, y, w, h = self.x[idx], self.y[idx], self.w[idx], self.h[idx]
+    hit = (x - w < x1) & (x + w > x0) & (y - h < y1) & (y + h > y0)
+    return np.sort(idx[hit])
@@ -0,0 +1,39 @@
+import random
+
+import pytest
+
+import aabb
+
+def slide_one(x, y, w, h, dx, dy, tiles):
+  # the scalar loop slide_out replaces: nearest tile first, one at a time
+  tiles = sorted(tiles, key=lambda t: abs(t[0] + t[2] / 2. - x) + abs(t[1] + t[3] / 2. - y))
+  for tx, ty, tw, th in tiles:
+    sx, sy = aabb.collide_and_slide(dx, dy, x - w, y - h, 2 * w, 2 * h, tx, ty, tw, th)
+    x += sx
+    y += sy
+  return x, y
+
+@pytest.mark.parametrize('seed', range(20))
+def test_slide_out(seed):
+  rng = random.Random(seed)
+  for _ in range(100):
+    boxes, velocities, tiles, owners = [], [], [], []
+    for i in range(rng.randint(1, 20)):
+      boxes.append((
+        rng.uniform(0, 20), rng.uniform(0, 20), rng.choice([0.4, 0.5]), rng.choice([0.4, 0.5]),
+      ))
+      # standing still on an axis is the common case
+      velocities.append((rng.choice([0, rng.uniform(-7, 7)]), rng.choice([0, rng.uniform(-7, 7)])))
+      for _ in range(rng.randint(0, 4)):
+        tiles.append((
+          rng.randint(0, 20) - 0.5, rng.randint(0, 20) - 0.5, rng.randint(1, 3), rng.randint(1, 3),
+        ))
+        owners.append(i)
+    pos = aabb.slide_out(boxes, velocities, tiles, owners)
+    for i, (box, velocity) in enumerate(zip(boxes, velocities)):
+      mine = [t for t, o in zip(tiles, owners) if o == i]
+      assert tuple(pos[i]) == slide_one(*box, *velocity, mine)
+
+def test_slide_out_nothing():
+  pos = aabb.slide_out([(1., 2., 0.5, 0.5)], [(3., 0.)], [], [])
+  assert pos.tolist() == [[1., 2.]]
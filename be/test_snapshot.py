@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import snapshot
+
+def view(tick, n=3):
+  states = np.zeros(n, dtype=snapshot.STATE)
+  states['x'] = tick
+  return snapshot.Snapshot(tick, np.arange(n, dtype=np.uint32), states)
+
+@pytest.mark.parametrize('every', [1, 2, 3, 7])
+@pytest.mark.parametrize('acks', [False, True])
+def test_history_bounded(every, acks):
+  deltas = snapshot.DeltaEncoder(keyframe_interval=120, history_length=64)
+  for tick in range(0, 1000 * every, every):
+    deltas.encode('viewer', view(tick))
+    if acks and tick % 10 == 0:
+      deltas.ack('viewer', tick)
+  history = deltas.history['viewer']
+  # the window, plus the acked base and the last keyframe
+  assert len(history) <= 64 // every + 1 + 2
+  # both of those are still there to encode against
+  assert deltas.last_keyframe['viewer'] in history
+  if acks:
+    assert deltas.acked['viewer'] in history
+
+def test_keeps_stale_ack():
+  deltas = snapshot.DeltaEncoder(keyframe_interval=10000, history_length=8)
+  deltas.encode('viewer', view(0))
+  deltas.encode('viewer', view(3))
+  deltas.ack('viewer', 3)
+  for tick in range(6, 300, 3):
+    payload = deltas.encode('viewer', view(tick))
+  # still a delta against the acked tick, it was never pruned
+  assert 3 in deltas.history['viewer']
+  assert not snapshot.is_keyframe(payload)
+  assert len(deltas.history['viewer']) <= 8 // 3 + 1 + 2
@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+import pytest
+
+import aabb
+import spatial
+
+class Box:
+  def __init__(self, x, y, w, h):
+    self.aabb_x, self.aabb_y, self.aabb_w, self.aabb_h = x, y, w, h
+
+  def aabb(self):
+    return self.aabb_x, self.aabb_y, self.aabb_w, self.aabb_h
+
+def random_boxes(rng, n):
+  # mostly entity sized, some spanning many cells, some on cell boundaries
+  boxes = []
+  for _ in range(n):
+    size = rng.choice([0.5, 1., rng.uniform(0.1, 2.), rng.uniform(2., 9.)])
+    x = rng.choice([rng.uniform(-20, 20), float(rng.randint(-10, 10) * 2)])
+    y = rng.choice([rng.uniform(-20, 20), float(rng.randint(-10, 10) * 2)])
+    boxes.append(Box(x, y, size, rng.choice([size, rng.uniform(0.1, 4.)])))
+  return boxes
+
+@pytest.mark.parametrize('seed', range(20))
+def test_spatial_hash(seed):
+  rng = random.Random(seed)
+  boxes = random_boxes(rng, rng.randint(0, 150))
+  grid = spatial.SpatialHash(cell_size=rng.choice([1., 2., 3.5]))
+  grid.rebuild(boxes)
+
+  pairs = [frozenset((id(a), id(b))) for a, b in grid.colliding_pairs()]
+  # every pair is reported once, and nothing but intersecting pairs
+  assert len(pairs) == len(set(pairs))
+  expected = {
+    frozenset((id(a), id(b)))
+    for i, a in enumerate(boxes) for b in boxes[i + 1:]
+    if aabb.intersect(*a.aabb(), *b.aabb())
+  }
+  assert set(pairs) == expected
+
+  for _ in range(20):
+    q = random_boxes(rng, 1)[0]
+    found = grid.query(*q.aabb())
+    assert {b for b in boxes if aabb.intersect(*q.aabb(), *b.aabb())} <= found
+
+@pytest.mark.parametrize('seed', range(20))
+def test_grid_index(seed):
+  rng = np.random.default_rng(seed)
+  n = int(rng.integers(0, 300))
+  x = rng.uniform(-50, 50, n)
+  y = rng.uniform(-50, 50, n)
+  # half sizes, a few larger than the cells
+  w = np.where(rng.random(n) < 0.1, rng.uniform(4, 20, n), rng.uniform(0.1, 1, n))
+  h = np.where(rng.random(n) < 0.1, rng.uniform(4, 20, n), rng.uniform(0.1, 1, n))
+  index = spatial.GridIndex(x, y, w, h, cell_size=float(rng.choice([2., 8.])))
+  for _ in range(50):
+    x0, y0 = rng.uniform(-70, 70, 2)
+    x1, y1 = x0 + rng.uniform(0, 40), y0 + rng.uniform(0, 40)
+    expected = ((x - w < x1) & (x + w > x0) & (y - h < y1) & (y + h > y0)).nonzero()[0]
+    np.testing.assert_array_equal(index.query(x0, y0, x1, y1), expected)
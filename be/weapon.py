@@ -1,8 +1,6 @@
 import math
 import random
 
-import entity
-
 class Pistol:
 
   def __init__(self, game, user):
@@ -21,13 +19,13 @@ class Pistol:
     if not shoot_dx and not shoot_dy:
       return
 
-    self.game.add_entity(entity.Bullet(
-      self.game, self.user,
+    self.game.spawn_bullet(
+      self.user,
       self.user.x, self.user.y,
       (shoot_dx, shoot_dy),
       # impart momentum in the direction we are not firing
       (self.user.dx if shoot_dy else 0, self.user.dy if shoot_dx else 0)
-    ))
+    )
     self.user.shoot_cooldown = self.max_shoot_cooldown
 
 class Shotgun:
@@ -62,16 +60,15 @@ class Shotgun:
         spread = 0
       else:
         spread = random.uniform(-self.max_spread, self.max_spread)
-      bullet = entity.Bullet(
-        self.game, self.user,
+      self.game.spawn_bullet(
+        self.user,
         self.user.x, self.user.y,
         (shoot_dx + (spread if shoot_dy else 0),
         shoot_dy + (spread if shoot_dx else 0)),
         momentum,
+        lifespan=self.bullet_lifespan,
+        dmg=self.bullet_dmg,
       )
-      bullet.lifespan = self.bullet_lifespan
-      bullet.dmg = self.bullet_dmg
-      self.game.add_entity(bullet)
 
     self.user.shoot_cooldown = self.max_shoot_cooldown
 
@@ -85,6 +82,7 @@ class Sniper:
     self.max_shoot_cooldown = 60
     self.bullet_dmg = 25
     self.bullet_speed = 40
+    self.bullet_size = 0.25
     self.bullet_aspect_ratio = 4
 
   def use(self, shoot_dx, shoot_dy):
@@ -97,21 +95,23 @@ class Sniper:
       return
 
     momentum = (self.user.dx if shoot_dy else 0, self.user.dy if shoot_dx else 0)
-    bullet = entity.Bullet(
-      self.game, self.user,
-      self.user.x, self.user.y,
+    x, y = self.user.x, self.user.y
+    w = h = self.bullet_size
+    if shoot_dx:
+      w *= self.bullet_aspect_ratio
+      x += w * shoot_dx
+    if shoot_dy:
+      h *= self.bullet_aspect_ratio
+      y += h * shoot_dy
+    self.game.spawn_bullet(
+      self.user,
+      x, y,
       (shoot_dx , shoot_dy),
       momentum,
+      w=w, h=h,
+      dmg=self.bullet_dmg,
+      speed=self.bullet_speed,
     )
-    bullet.dmg = self.bullet_dmg
-    bullet.speed = self.bullet_speed
-    if shoot_dx:
-      bullet.w *= self.bullet_aspect_ratio
-      bullet.x += bullet.w * shoot_dx
-    if shoot_dy:
-      bullet.h *= self.bullet_aspect_ratio
-      bullet.y += bullet.h * shoot_dy
-    self.game.add_entity(bullet)
 
     self.user.shoot_cooldown = self.max_shoot_cooldown
 
@@ -125,7 +125,8 @@ class Laser:
     self.max_shoot_cooldown = 90
     self.laser_dmg = 2
     self.laser_lifespan = 30
-    self.laser_length = 100
+    self.laser_width = 0.25
+    self.laser_range = 50
 
   def use(self, shoot_dx, shoot_dy):
     if self.user.shoot_cooldown:
@@ -136,30 +137,31 @@ class Laser:
     if not shoot_dx and not shoot_dy:
       return
 
-    bullet = entity.Bullet(
-      self.game, self.user,
-      self.user.x, self.user.y,
-      (0, 0),
-    )
-    bullet.lifespan = self.laser_lifespan
-    bullet.dmg = self.laser_dmg
-    bullet.speed = 0
+    # the beam runs from the user up to the first wall in its way
+    x, y = self.user.x, self.user.y
+    length, _ = self.game.world.raycast(x, y, shoot_dx, shoot_dy, self.laser_range)
+    w = h = self.laser_width
     if shoot_dx:
-      bullet.w *= self.laser_length
-      bullet.x += bullet.w * shoot_dx
+      w = length / 2.
+      x += w * shoot_dx
     if shoot_dy:
-      bullet.h *= self.laser_length
-      bullet.y += bullet.h * shoot_dy
-    def modified_collide(other):
-      if bullet.src == other:
-        return
-      other.damage(bullet.dmg)
-    def modified_collide_tile(other):
-      pass
-
-    bullet.collide = modified_collide
-    bullet.collide_tile = modified_collide_tile
-    self.game.add_entity(bullet)
+      h = length / 2.
+      y += h * shoot_dy
+    # the beam stays put, passes through entities and hurts everything it
+    # touches, every tick
+    bullet_id = self.game.spawn_bullet(
+      self.user,
+      x, y,
+      (0, 0),
+      w=w, h=h,
+      speed=0,
+      lifespan=self.laser_lifespan,
+      dmg=self.laser_dmg,
+      pierce_entities=True,
+      pierce_walls=True,
+    )
+    # the beam is much longer than the view, always show it to the shooter
+    self.user.tracked.add(bullet_id)
 
     self.user.shoot_cooldown = self.max_shoot_cooldown
 
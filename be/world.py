@@ -1,45 +1,199 @@
 import numpy as np
 
+import json
 import math
+import os
 import random
 
 import aabb
 
+# tiles players enter and leave a level through
+START_TILE = 4
+END_TILE = 6
+
 class World:
 
+  # arrays a world is made of, in the order they are saved (see save/load)
+  arrays = [
+    'tiles', 'collision_mask', 'rects', 'rect_index', 'collision_sat',
+    'render_grid',
+  ]
+
   def __init__(self, tiles, tile_to_sprite_id=lambda x: x, spawnx=0, spawny=0):
     tiles = np.asarray(tiles) # convert to array if not already
     self.tiles = tiles
 
-    # compute bounding boxes
-    xi, yi = (tiles % 2).nonzero() # odd tiles have collision boxes
-    self.aabbs = [] # TODO turn into quad tree, and maybe merge adjacent tiles to one aabb
-    for x, y in zip(xi, yi):
-      self.aabbs.append((x - 0.5, y - 0.5))
+    # collision mask, odd tiles have collision boxes
+    # the box of tile (x, y) is the unit square centred at (x, y)
+    self.collision_mask = (tiles % 2).astype(bool)
+    # merge the wall tiles into larger boxes so fewer of them need resolving
+    self.rects, self.rect_index = merge_rects(self.collision_mask)
+    # summed area table of the collision mask, for vectorized box queries
+    self.collision_sat = np.zeros((tiles.shape[0] + 1, tiles.shape[1] + 1), dtype=np.int32)
+    self.collision_sat[1:, 1:] = self.collision_mask.cumsum(0).cumsum(1)
 
-    # compute renderable data
-    self.render = np.vectorize(tile_to_sprite_id)(self.tiles).tolist()
+    # compute renderable data (only needs converting once per kind of tile)
+    kinds, kind = np.unique(tiles, return_inverse=True)
+    sprite_ids = np.array([tile_to_sprite_id(k) for k in kinds.tolist()])
+    self.render_grid = sprite_ids[kind.reshape(tiles.shape)]
 
     # default player spawn
     self.spawnx = spawnx
     self.spawny = spawny
-
+    self.setup()
+
+  def setup(self):
+    # everything that is cheap to derive from the arrays
+    self.rect_aabbs = [(x - 0.5, y - 0.5, w, h) for x, y, w, h in self.rects.tolist()]
+
+  @property
+  def render(self):
+    # sprite id of every tile, as nested lists
+    return self.render_grid.tolist()
+
+  def save(self, path):
+    # writes the world to the directory path as one .npy file per array, plus
+    # the spawn point. tiles and sprite ids are stored as bytes if they fit
+    os.makedirs(path)
+    for name in self.arrays:
+      arr = np.asarray(getattr(self, name))
+      if name in ('tiles', 'render_grid') and (arr.astype(np.uint8) == arr).all():
+        arr = arr.astype(np.uint8)
+      np.save(os.path.join(path, name + '.npy'), arr)
+    with open(os.path.join(path, 'world.json'), 'w') as f:
+      json.dump({'spawnx': self.spawnx, 'spawny': self.spawny}, f)
+
+  @classmethod
+  def load(cls, path, mmap_mode='r'):
+    # reads a world written by save. by default the arrays are memory mapped
+    # read only, so every process that loads the same world shares its pages
+    world = cls.__new__(cls)
+    for name in cls.arrays:
+      setattr(world, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+    with open(os.path.join(path, 'world.json')) as f:
+      meta = json.load(f)
+    world.spawnx = meta['spawnx']
+    world.spawny = meta['spawny']
+    world.setup()
+    return world
+
+  def cell_range(self, aabb_x, aabb_y, aabb_w, aabb_h):
+    # inclusive range of tiles whose box strictly intersects the aabb
+    # (tile x overlaps iff aabb_x - 0.5 < x < aabb_x + aabb_w + 0.5)
+    width, height = self.tiles.shape
+    x0 = max(math.floor(aabb_x - 0.5) + 1, 0)
+    y0 = max(math.floor(aabb_y - 0.5) + 1, 0)
+    x1 = min(math.ceil(aabb_x + aabb_w + 0.5) - 1, width - 1)
+    y1 = min(math.ceil(aabb_y + aabb_h + 0.5) - 1, height - 1)
+    return x0, y0, x1, y1
 
   def intersect(self, aabb_x, aabb_y, aabb_w, aabb_h):
-    intersects = []
-    for x, y in self.aabbs:
-      if aabb.intersect(aabb_x, aabb_y, aabb_w, aabb_h, x, y, 1, 1):
-        intersects.append((x, y, 1, 1))
-    return intersects
+    # only look at the tiles the aabb covers, so this is independent of map size
+    x0, y0, x1, y1 = self.cell_range(aabb_x, aabb_y, aabb_w, aabb_h)
+    if x0 > x1 or y0 > y1:
+      return []
+    ids = self.rect_index[x0:x1+1, y0:y1+1]
+    ids = ids[ids >= 0].tolist()
+    # a box can cover several of the cells, only return it once
+    return [self.rect_aabbs[i] for i in dict.fromkeys(ids)]
+
+  def any_wall(self, aabb_x, aabb_y, aabb_w, aabb_h):
+    # vectorized version of intersect for arrays of aabbs, only returns
+    # whether each aabb touches any wall
+    width, height = self.tiles.shape
+    # same ranges as cell_range, but half open
+    x0 = np.clip(np.floor(aabb_x - 0.5).astype(np.int64) + 1, 0, width)
+    y0 = np.clip(np.floor(aabb_y - 0.5).astype(np.int64) + 1, 0, height)
+    x1 = np.clip(np.ceil(aabb_x + aabb_w + 0.5).astype(np.int64), x0, width)
+    y1 = np.clip(np.ceil(aabb_y + aabb_h + 0.5).astype(np.int64), y0, height)
+    sat = self.collision_sat
+    return (sat[x1, y1] - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]) > 0
+
+  def raycast(self, ox, oy, dx, dy, max_dist=math.inf):
+    # distance along the ray to the first wall and the wall tile, see
+    # aabb.raycast
+    return aabb.raycast(self.collision_mask, ox, oy, dx, dy, max_dist)
+
+def merge_rects(mask):
+  # greedy meshing of the true cells of mask into disjoint rectangles.
+  # each rectangle is grown along y first, then along x as long as the whole
+  # column segment is still free.
+  # returns an (N, 4) array of rects (x, y, w, h) in cells and a grid with the
+  # index of the rect covering each cell (-1 if none)
+  width, height = mask.shape
+  index = np.full(mask.shape, -1, dtype=np.int32)
+  rects = []
+  free = mask.copy()
+  for x, y in zip(*(v.tolist() for v in mask.nonzero())):
+    if not free[x, y]:
+      continue
+    # grow along y
+    h = 1
+    while y + h < height and free[x, y + h]:
+      h += 1
+    # grow along x
+    w = 1
+    while x + w < width and free[x + w, y:y + h].all():
+      w += 1
+    free[x:x + w, y:y + h] = False
+    index[x:x + w, y:y + h] = len(rects)
+    rects.append((x, y, w, h))
+  return np.array(rects, dtype=np.int32).reshape(-1, 4), index
+
+def rect_counts(shape, x0, y0, x1, y1):
+  # number of the rects [x0, x1) x [y0, y1) covering each cell of a grid,
+  # with a 2d difference array
+  diff = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int32)
+  x1 = np.maximum(x1, x0)
+  y1 = np.maximum(y1, y0)
+  np.add.at(diff, (x0, y0), 1)
+  np.add.at(diff, (x1, y0), -1)
+  np.add.at(diff, (x0, y1), -1)
+  np.add.at(diff, (x1, y1), 1)
+  return diff.cumsum(0).cumsum(1)[:shape[0], :shape[1]]
+
+def label_components(mask):
+  # labels the 4-connected components of the true cells of mask with 1, 2, ...
+  # in the order a row major scan first reaches them (0 elsewhere).
+  # returns the labels and the number of components
+  # vectorized union find: every round links the roots of all edges whose
+  # ends are in different trees, smaller root wins, then compresses all paths
+  n = mask.size
+  idx = np.arange(n).reshape(mask.shape)
+  both_x = mask[:-1, :] & mask[1:, :]
+  both_y = mask[:, :-1] & mask[:, 1:]
+  a = np.concatenate([idx[:-1, :][both_x], idx[:, :-1][both_y]])
+  b = np.concatenate([idx[1:, :][both_x], idx[:, 1:][both_y]])
+  parent = np.arange(n)
+  while len(a):
+    pa = parent[a]
+    pb = parent[b]
+    apart = pa != pb
+    # edges within one tree stay that way
+    a, b, pa, pb = a[apart], b[apart], pa[apart], pb[apart]
+    np.minimum.at(parent, np.maximum(pa, pb), np.minimum(pa, pb))
+    while True:
+      grandparent = parent[parent]
+      if (grandparent == parent).all():
+        break
+      parent = grandparent
+  # every tree's root is its first cell in scan order
+  roots = (parent == np.arange(n)) & mask.ravel()
+  number = roots.cumsum()
+  labels = np.where(mask.ravel(), number[parent], 0).reshape(mask.shape)
+  return labels, int(number[-1]) if n else 0
 
 def gen_dungeon(
   width=100, height=100,
   min_room_size=10, max_room_size=15, num_rooms=20,
-  max_corridor_length=25, corridor_width=3,
+  max_corridor_length=25, corridor_width=3, seed=24,
 ):
   # possibly the most spaghetti code i have written in my life begins here
+  # (vectorized where it doesn't change the result, the same seed gives the
+  # same dungeon as the original, quirks included)
   assert width >= 3, "min width is 3"
   assert height >= 3, "min height is 3"
+  assert min_room_size >= 1
   assert max_room_size >= min_room_size, "what u doing"
   assert max_room_size <= width
   assert max_room_size <= height
@@ -53,35 +207,35 @@ def gen_dungeon(
     arr[arr == void] = val
 
   # begin generation here
-  tiles = np.zeros((width, height))
-  random.seed(24)
+  rng = random.Random(seed)
 
   # ******* room generation *******
+  rooms = []
   for _ in range(num_rooms):
-    room_w = random.randint(min_room_size, max_room_size)
-    room_h = random.randint(min_room_size, max_room_size)
-    x = random.randrange(0, width-room_w)
-    y = random.randrange(0, height-room_h)
-
-    # four walls of the rooms
-    # make sure you only overwrite 0 (void) tiles to wall
-    set_if_void(tiles[x:x+room_w, y], 3)
-    set_if_void(tiles[x:x+room_w, y+room_h-1], 3)
-    set_if_void(tiles[x, y:y+room_h], 3)
-    set_if_void(tiles[x+room_w-1, y:y+room_h], 3)
-    # center of the room
-    tiles[x+1:x+room_w-1, y+1:y+room_h-1] = 2
+    room_w = rng.randint(min_room_size, max_room_size)
+    room_h = rng.randint(min_room_size, max_room_size)
+    x = rng.randrange(0, width-room_w)
+    y = rng.randrange(0, height-room_h)
+    rooms.append((x, y, room_w, room_h))
+  x, y, w, h = np.array(rooms).T
+  # the centres of the rooms are floor, and the four walls of the rooms only
+  # overwrite void. so in the end every tile in the centre of any room is
+  # floor, any other tile on the walls of a room is wall
+  covered = rect_counts((width, height), x, y, x + w, y + h)
+  centre = rect_counts((width, height), x + 1, y + 1, x + w - 1, y + h - 1)
+  tiles = np.where(centre > 0, 2., np.where(covered > centre, 3., 0.))
 
   # find a random start/end point
+  floor = (tiles == 2).tobytes() # floor[x * height + y]
   for i in range(100005):
     # note: for some unlucky configurations of rooms this can run forever
     if i > 100000:
-      raise "Unlucky room generation. Change RNG seed and try again"
-    sx, sy = random.randrange(0, width), random.randrange(0, height)
-    if tiles[sx, sy] != 2:
+      raise RuntimeError("Unlucky room generation. Change RNG seed and try again")
+    sx, sy = rng.randrange(0, width), rng.randrange(0, height)
+    if not floor[sx * height + sy]:
       continue
-    ex, ey = random.randrange(0, width), random.randrange(0, height)
-    if tiles[ex, ey] != 2:
+    ex, ey = rng.randrange(0, width), rng.randrange(0, height)
+    if not floor[ex * height + ey]:
       continue
 
     if abs(sx - ex) + abs(sy - ey) > (width + height) // 2:
@@ -93,27 +247,23 @@ def gen_dungeon(
 
   # ******* corridors between rooms *******
 
-  # dfs helper
-  visited = np.zeros_like(tiles)
-  def dfs(ux, uy, colour, bkgd=0):
-    # dfs function that recursively paint buckets a bkgd colour to a different one
-    stack = [(ux, uy)]
-    while stack:
-      ux, uy = stack.pop()
-      visited[ux, uy] = colour
-      neighbours = [(ux - 1, uy), (ux + 1, uy), (ux, uy - 1), (ux, uy + 1)]
-      for vx, vy in neighbours:
-        if in_bounds(vx, vy) and tiles[vx, vy] == 2 and visited[vx, vy] == bkgd:
-          stack.append((vx, vy))
-
   # colour each room differently
-  colour = 1
-  for x in range(width):
-    for y in range(width):
-      if tiles[x, y] == 2 and not visited[x, y]:
-        dfs(x, y, colour)
-        colour += 1
-  colours = set(range(1, colour)) # remaining colours we haven't merged yet
+  # (rooms are only looked for in the first `width` columns)
+  visited = np.zeros((width, height), dtype=np.int64)
+  scan = min(width, height)
+  visited[:, :scan], num_colours = label_components(tiles[:, :scan] == 2)
+  colours = set(range(1, num_colours + 1)) # remaining colours we haven't merged yet
+  # merging two rooms renames every tile of one to the colour of the other,
+  # the tiles keep their old colours in visited and root maps them to their
+  # current one, so the tile colours are root[visited]
+  root = np.arange(num_colours + 1)
+  # colours a corridor cut through, they may not be connected any more.
+  # those can't be renamed wholesale, only the part connected to the corridor
+  split = np.zeros(num_colours + 1, dtype=bool)
+  if width != height:
+    # corridors may leave the scanned columns, and rooms there are never
+    # connected to anything
+    split[:] = True
 
   # half the width of a corridor
   offset = corridor_width // 2
@@ -122,17 +272,20 @@ def gen_dungeon(
   # all adjacent squares within a radius of offset (manhattan distance)
   adjs = [(x, y) for x in range(-offset, offset+1) for y in range(-offset, offset+1)]
   for _ in range(10005):
+    if len(colours) <= 1:
+      # everything is connected, nothing left to do
+      break
     # pick starting point for the corridor
-    x, y = random.randrange(offset+1, width-offset-1), random.randrange(offset+1, height-offset-1)
+    x, y = rng.randrange(offset+1, width-offset-1), rng.randrange(offset+1, height-offset-1)
 
     # make sure that the starting point is inside a room
-    cur_colour = visited[x, y]
+    cur_colour = root[visited[x, y]]
     if cur_colour == 0:
       # not in a room
       continue
     # if the starting point is in a room, we still need to make sure
     # there is enough room for a corridor
-    if not (visited[x-offset:x+offset+1, y-offset:y+offset+1] == cur_colour).all():
+    if not (root[visited[x-offset:x+offset+1, y-offset:y+offset+1]] == cur_colour).all():
       # if we enter here, then there is not enough room for a hallway centred
       # at x, y. However, there may be a valid starting point within the
       # square centred at (x, y) with radius offset, ie., the array adj
@@ -140,11 +293,11 @@ def gen_dungeon(
 
       # by doing it this way, we increase the likelihood that a corridor
       # can start inside another corridor
-      random.shuffle(adjs)
+      rng.shuffle(adjs)
       tmp_x, tmp_y = x, y
       for dx, dy in adjs:
         x, y = tmp_x + dx, tmp_y + y
-        if (visited[x-1:x+2, y-1:y+2] == cur_colour).all():
+        if (root[visited[x-1:x+2, y-1:y+2]] == cur_colour).all():
           # found a valid starting point
           break
       else: # for else clause
@@ -153,53 +306,63 @@ def gen_dungeon(
 
     done = False
     # try all the possible directions the corridor can go
-    random.shuffle(dirs) # remove bias from directions
+    rng.shuffle(dirs) # remove bias from directions
+    if not in_bounds(x, y):
+      continue
     for dx, dy in dirs:
+      # try all the possible lengths the corridor can be, as long as it stays
+      # in bounds
+      steps = max_corridor_length
+      if dx:
+        steps = min(steps, width - x if dx > 0 else x + 1)
+      if dy:
+        steps = min(steps, width - y if dy > 0 else y + 1)
+      step = np.arange(steps)
+      line = root[visited[x + dx * step, y + dy * step]]
+      # the ending point has to be inside another room
+      for step in ((line != cur_colour) & (line != 0)).nonzero()[0].tolist():
+        ox, oy = x + dx * step, y + dy * step
+        other_colour = line[step]
+        # check to make sure other connection is wide enough
+        # corridor width in x and y directions resp.
+        cw_x = abs(dy * offset)
+        cw_y = abs(dx * offset)
+        if (root[visited[ox-cw_x:ox+cw_x+1, oy-cw_y:oy+cw_y+1]] == other_colour).all():
+          dir = (dx, dy)
+          done = True
+          break
       if done:
         break
-      # try all the possible lengths the corridor can be
-      for step in range(max_corridor_length):
-        if done:
-          break
-        if not in_bounds(x + dx * step, y + dy * step):
-          break
-        # make sure that the ending point is inside a room
-        if visited[x + dx * step, y + dy * step] != cur_colour:
-          ox, oy = x + dx * step, y + dy * step
-          other_colour = visited[ox, oy]
-          if not other_colour:
-            continue
-          # check to make sure other connection is wide enough
-          # corridor width in x and y directions resp.
-          cw_x = abs(dy * offset)
-          cw_y = abs(dx * offset)
-          if (visited[ox-cw_x:ox+cw_x+1, oy-cw_y:oy+cw_y+1] == other_colour).all():
-            dir = (dx, dy)
-            done = True
-            break
     if not done:
       continue
     # fill other room with this colour
-    dfs(ox, oy, cur_colour, bkgd=other_colour)
+    if split[other_colour]:
+      # only the part connected to the corridor
+      part, _ = label_components(root[visited[:, :scan]] == other_colour)
+      visited[:, :scan][part == part[ox, oy]] = cur_colour
+    else:
+      root[root == other_colour] = cur_colour
     # fill in the corridor tiles
     dx, dy = dir
     if dx:
       # horizontal
-      tiles[x:ox+dx:dx, y-offset:y+offset+1] = 2
-      visited[x:ox+dx:dx, y-offset:y+offset+1] = cur_colour
-      set_if_void(tiles[x:ox+dx:dx, y-offset-1], 3)
-      set_if_void(tiles[x:ox+dx:dx, y+offset+1], 3)
+      corridor = np.s_[x:ox+dx:dx, y-offset:y+offset+1]
+      walls = [np.s_[x:ox+dx:dx, y-offset-1], np.s_[x:ox+dx:dx, y+offset+1]]
     if dy:
-      # horizontal
-      tiles[x-offset:x+offset+1, y:oy+dy:dy] = 2
-      visited[x-offset:x+offset+1, y:oy+dy:dy] = cur_colour
-      set_if_void(tiles[x-offset-1, y:oy+dy:dy], 3)
-      set_if_void(tiles[x+offset+1, y:oy+dy:dy], 3)
+      # vertical
+      corridor = np.s_[x-offset:x+offset+1, y:oy+dy:dy]
+      walls = [np.s_[x-offset-1, y:oy+dy:dy], np.s_[x+offset+1, y:oy+dy:dy]]
+    cut = np.unique(root[visited[corridor]])
+    split[cut[(cut != cur_colour) & (cut != 0)]] = True
+    tiles[corridor] = 2
+    visited[corridor] = cur_colour
+    for wall in walls:
+      set_if_void(tiles[wall], 3)
     colours.remove(other_colour)
 
   # TODO: after this step there still could be isolated rooms
   if len(colours) > 1:
-    raise "bad generation seed? there are still disconnected rooms (todo!)"
+    raise RuntimeError("bad generation seed? there are still disconnected rooms (todo!)")
 
   # ******* structures *******
   # TODO (like obstacles and stuff?)
@@ -207,8 +370,8 @@ def gen_dungeon(
 
   # start / end tiles
   # (maybe like ladders or something to enter/exit this level)
-  tiles[start_x, start_y] = 4
-  tiles[end_x, end_y] = 6
+  tiles[start_x, start_y] = START_TILE
+  tiles[end_x, end_y] = END_TILE
 
   def to_colour(tile):
     # spaghetti hardcoded magic numbers for now, until sprites are done
@@ -224,5 +387,3 @@ def gen_dungeon(
       return 4
 
   return World(tiles, to_colour, start_x, start_y)
-
-
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# on disk cache of generated dungeons. generation is deterministic, so a level
+# is identified by the generator parameters (seed included) and only ever has
+# to be generated once. cached levels are memory mapped when loaded, so
+# loading is near instant and server processes share the pages
+#
+# pregenerate levels with: python worldcache.py [--dir DIR] --seeds 0-99 ...
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import traceback
+
+import world
+
+# bump whenever gen_dungeon or the saved World arrays change, so levels cached
+# by older versions are regenerated rather than loaded
+VERSION = 1
+
+def dungeon_params(**params):
+  # every gen_dungeon parameter, defaults filled in
+  bound = inspect.signature(world.gen_dungeon).bind(**params)
+  bound.apply_defaults()
+  return dict(bound.arguments)
+
+def key(**params):
+  # name of the level generated with these parameters
+  blob = json.dumps({'version': VERSION, **dungeon_params(**params)}, sort_keys=True)
+  return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+def level_path(cache_dir, **params):
+  return os.path.join(cache_dir, key(**params))
+
+def save(cache_dir, w, **params):
+  # saves w as the level for params. the level is written next to its final
+  # place and renamed into it, so other processes never see half a level
+  path = level_path(cache_dir, **params)
+  tmp = f'{path}.tmp{os.getpid()}'
+  os.makedirs(cache_dir, exist_ok=True)
+  w.save(tmp)
+  with open(os.path.join(tmp, 'params.json'), 'w') as f:
+    json.dump(dungeon_params(**params), f, sort_keys=True)
+  try:
+    os.rename(tmp, path)
+  except OSError:
+    # someone else saved it first
+    shutil.rmtree(tmp, ignore_errors=True)
+  return path
+
+def load_dungeon(cache_dir, **params):
+  # the dungeon gen_dungeon(**params) would generate, from the cache if it is
+  # there, otherwise generated and cached
+  path = level_path(cache_dir, **params)
+  if os.path.isdir(path):
+    try:
+      return world.World.load(path)
+    except (OSError, ValueError, KeyError):
+      # unreadable, eg., from a crash while it was being replaced
+      shutil.rmtree(path, ignore_errors=True)
+  save(cache_dir, world.gen_dungeon(**params), **params)
+  return world.World.load(path)
+
+def parse_seeds(spec):
+  # '3' or '0-99' or '1,5,10-12'
+  seeds = []
+  for part in spec.split(','):
+    lo, _, hi = part.partition('-')
+    seeds += range(int(lo), int(hi or lo) + 1)
+  return seeds
+
+def main():
+  parser = argparse.ArgumentParser(description='pregenerate dungeon levels into the world cache')
+  parser.add_argument('--dir', default='levels', help='cache directory')
+  parser.add_argument('--seeds', type=parse_seeds, default=[24],
+    help="seeds to generate, eg., '0-99' or '1,5,10-12'")
+  parser.add_argument('--force', action='store_true', help='regenerate levels that are already cached')
+  # generator parameters
+  defaults = dungeon_params()
+  for name, default in defaults.items():
+    if name != 'seed':
+      parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+  args = parser.parse_args()
+  params = {name: getattr(args, name) for name in defaults if name != 'seed'}
+
+  generated = cached = failed = 0
+  for seed in args.seeds:
+    path = level_path(args.dir, seed=seed, **params)
+    if os.path.isdir(path):
+      if not args.force:
+        cached += 1
+        continue
+      shutil.rmtree(path)
+    t = time.perf_counter()
+    try:
+      w = world.gen_dungeon(seed=seed, **params)
+    except RuntimeError as e:
+      # some seeds don't give a connected dungeon
+      print(f'seed {seed}: failed ({e})')
+      failed += 1
+      continue
+    except Exception:
+      # a generator bug (eg., IndexError on maps wider than tall), don't let
+      # it take the rest of the batch down
+      print(f'seed {seed}: failed')
+      traceback.print_exc()
+      failed += 1
+      continue
+    save(args.dir, w, seed=seed, **params)
+    print(f'seed {seed}: {path} ({time.perf_counter() - t:.2f}s)')
+    generated += 1
+  print(f'{generated} generated, {cached} already cached, {failed} failed')
+
+if __name__ == '__main__':
+  main()
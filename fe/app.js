@@ -138,6 +138,7 @@ let sprites = [ // TODO improve sprite loading system
   0xffff00,
   0xff00ff,
   0x00ffff,
+  0xff8000, // enemies
 ];
 
 const colours = {
@@ -151,11 +152,14 @@ const colours = {
 const chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890 .!?";
 let fontTex;
 
-const keys = {};
+// held keys are sent as a bitmask, the bit of each key is its index here
+// (see be/keys.py, keep the two in sync)
+const KEY_BITS = ['w', 'a', 's', 'd', 'arrowup', 'arrowleft', 'arrowdown', 'arrowright', 'shift', ' '];
+let keys = 0;
 let keysChanged = false;
+let inputSeq = 0;
 let world = [[]];
 let entities = [];
-let healths = [];
 
 // position
 let camX = 0.;
@@ -206,12 +210,17 @@ const cameraSmoothCD = (dt) => {
 
 
 class Entity {
-  constructor(x, y, w, h, spriteID, isPlayer) {
+  constructor(x, y, w, h, spriteID, hp, maxHp, vx, vy, isPlayer) {
     this.x = x;
     this.y = y;
     this.w = w;
     this.h = h;
     this.spriteID = spriteID;
+    // entities without health have a maxHp of 0
+    this.hp = hp;
+    this.maxHp = maxHp;
+    this.vx = vx;
+    this.vy = vy;
     if (isPlayer) {
       playerX = x;
       playerY = y;
@@ -228,6 +237,201 @@ class Entity {
   }
 };
 
+// binary, delta compressed entity snapshots (see be/snapshot.py for the
+// layout, keep the two in sync)
+const SNAPSHOT_HEADER_SIZE = 32;
+const SNAPSHOT_SPAWN_SIZE = 40;
+const FLAG_KEYFRAME = 1;
+// changeable fields, the bit of each field in the change mask is its index
+const SNAPSHOT_FIELDS = [
+  [4, (view, off) => view.getFloat32(off, true)], // x
+  [4, (view, off) => view.getFloat32(off, true)], // y
+  [4, (view, off) => view.getFloat32(off, true)], // w
+  [4, (view, off) => view.getFloat32(off, true)], // h
+  [2, (view, off) => view.getUint16(off, true)], // sprite id
+  [4, (view, off) => view.getFloat32(off, true)], // hp
+  [4, (view, off) => view.getFloat32(off, true)], // max hp
+  [4, (view, off) => view.getFloat32(off, true)], // vx
+  [4, (view, off) => view.getFloat32(off, true)], // vy
+];
+
+// tick -> Map(entity id -> [x, y, w, h, spriteID, hp, maxHp, vx, vy]) of the recent snapshots,
+// deltas are applied on top of one of these. at most as many as the server
+// keeps (DeltaEncoder.history_length in be/snapshot.py), older bases are never used
+const snapshotStates = new Map();
+const MAX_SNAPSHOT_STATES = 64;
+
+const pruneSnapshotStates = (tick) => {
+  // drops the states from before tick
+  for (const t of snapshotStates.keys()) {
+    if (t < tick) snapshotStates.delete(t);
+  }
+};
+
+const applySnapshot = (buf) => {
+  // returns [tick, state, self id], or null if the base snapshot is unknown
+  const view = new DataView(buf);
+  const flags = view.getUint16(2, true);
+  const tick = view.getUint32(4, true);
+  const baseTick = view.getUint32(8, true);
+  const selfID = view.getUint32(12, true);
+  // (input seq at 16, this client doesn't number its key updates)
+  const numSpawned = view.getUint32(20, true);
+  const numDespawned = view.getUint32(24, true);
+  const numChanged = view.getUint32(28, true);
+
+  let state;
+  if (flags & FLAG_KEYFRAME) {
+    state = new Map();
+    // nothing before a keyframe is needed any more
+    pruneSnapshotStates(tick);
+  } else {
+    const base = snapshotStates.get(baseTick);
+    if (base === undefined) return null;
+    state = new Map(base);
+    // the server only ever moves the base forwards, so older states are dead
+    pruneSnapshotStates(baseTick);
+  }
+
+  let off = SNAPSHOT_HEADER_SIZE;
+  for (let i = 0; i < numSpawned; ++i, off += SNAPSHOT_SPAWN_SIZE) {
+    state.set(view.getUint32(off, true), [
+      view.getFloat32(off + 4, true), // x
+      view.getFloat32(off + 8, true), // y
+      view.getFloat32(off + 12, true), // w
+      view.getFloat32(off + 16, true), // h
+      view.getUint16(off + 20, true), // sprite id
+      view.getFloat32(off + 24, true), // hp
+      view.getFloat32(off + 28, true), // max hp
+      view.getFloat32(off + 32, true), // vx
+      view.getFloat32(off + 36, true), // vy
+    ]);
+  }
+  for (let i = 0; i < numDespawned; ++i, off += 4) {
+    state.delete(view.getUint32(off, true));
+  }
+
+  // changed entities: ids, then masks, then one column per field
+  const idsOff = off;
+  const masksOff = idsOff + 4 * numChanged;
+  const cursors = [];
+  off = masksOff + 2 * numChanged;
+  SNAPSHOT_FIELDS.forEach(([size], bit) => {
+    cursors.push(off);
+    for (let i = 0; i < numChanged; ++i) {
+      if (view.getUint16(masksOff + 2 * i, true) & (1 << bit)) off += size;
+    }
+  });
+  for (let i = 0; i < numChanged; ++i) {
+    const id = view.getUint32(idsOff + 4 * i, true);
+    const mask = view.getUint16(masksOff + 2 * i, true);
+    // copy on write, the old array may still be part of an older state
+    const rec = state.get(id).slice();
+    SNAPSHOT_FIELDS.forEach(([size, read], bit) => {
+      if (mask & (1 << bit)) {
+        rec[bit] = read(view, cursors[bit]);
+        cursors[bit] += size;
+      }
+    });
+    state.set(id, rec);
+  }
+
+  snapshotStates.set(tick, state);
+  // states go in in tick order, so the first ones are the oldest
+  for (const t of snapshotStates.keys()) {
+    if (snapshotStates.size <= MAX_SNAPSHOT_STATES) break;
+    snapshotStates.delete(t);
+  }
+  return [tick, state, selfID];
+};
+
+// snapshots may arrive well below the tick rate, so entities are drawn
+// interpDelay seconds in the past, between the two snapshots around that time.
+// if the next one is late, entities carry on along their velocity for a bit
+// (the server sends tps and interpDelay in 'clock', see be/server.py)
+let tps = 60;
+let interpDelay = 0.1;
+const MAX_EXTRAPOLATION = 0.25; // seconds
+const MAX_BUFFERED = 64;
+// [tick, state, self id] of the snapshots received, oldest first
+let interpBuffer = [];
+// estimated server tick at local time t (in seconds) is t * tps + tickOffset
+let tickOffset;
+
+const bufferSnapshot = (tick, state, selfID) => {
+  const sample = tick - performance.now() / 1000. * tps;
+  const last = interpBuffer[interpBuffer.length - 1];
+  if (tickOffset === undefined || Math.abs(sample - tickOffset) > 4 * interpDelay * tps) {
+    // first snapshot, or the clocks are way off (eg., the server stalled)
+    tickOffset = sample;
+  } else {
+    // arrival times jitter, average them out
+    tickOffset = lerp(tickOffset, sample, 0.05);
+  }
+  if (last !== undefined && tick <= last[0]) {
+    // the server started over
+    interpBuffer = [];
+  }
+  interpBuffer.push([tick, state, selfID]);
+  if (interpBuffer.length > MAX_BUFFERED) interpBuffer.shift();
+};
+
+const interpolate = () => {
+  // the entities as of interpDelay ago
+  if (interpBuffer.length === 0) return [];
+  const renderTick = (performance.now() / 1000. - interpDelay) * tps + tickOffset;
+  // keep the last snapshot from before renderTick, and everything after it
+  while (interpBuffer.length > 1 && interpBuffer[1][0] <= renderTick) interpBuffer.shift();
+  const [tickA, stateA, selfID] = interpBuffer[0];
+  const next = interpBuffer[1];
+  const amount = next === undefined ? 0 :
+    Math.min(Math.max((renderTick - tickA) / (next[0] - tickA), 0), 1);
+  const ahead = Math.min(Math.max((renderTick - tickA) / tps, 0), MAX_EXTRAPOLATION);
+  const result = [];
+  // entities that spawn in between only show up once their first snapshot
+  // is reached, the ones that despawn carry on along their velocity until then
+  stateA.forEach((a, id) => {
+    const b = next === undefined ? undefined : next[1].get(id);
+    let x, y;
+    if (b !== undefined) {
+      x = lerp(a[0], b[0], amount);
+      y = lerp(a[1], b[1], amount);
+    } else {
+      x = a[0] + a[7] * ahead;
+      y = a[1] + a[8] * ahead;
+    }
+    result.push(new Entity(x, y, ...a.slice(2), id === selfID));
+  });
+  return result;
+};
+
+// the world map arrives in chunks (see be/chunks.py for the layout, keep the
+// two in sync). world is indexed [x][y], tiles without a chunk yet are unknown
+const CHUNK_HEADER_SIZE = 12;
+const UNKNOWN_TILE = 255;
+
+const applyChunks = (buf) => {
+  const view = new DataView(buf);
+  let off = 0;
+  while (off < buf.byteLength) {
+    const worldW = view.getUint16(off, true);
+    const worldH = view.getUint16(off + 2, true);
+    const x = view.getUint16(off + 4, true);
+    const y = view.getUint16(off + 6, true);
+    const w = view.getUint16(off + 8, true);
+    const h = view.getUint16(off + 10, true);
+    off += CHUNK_HEADER_SIZE;
+    if (world.length !== worldW || world[0].length !== worldH) {
+      world = Array.from({length: worldW}, () => new Uint8Array(worldH).fill(UNKNOWN_TILE));
+    }
+    const tiles = new Uint8Array(buf, off, w * h);
+    for (let i = 0; i < w; ++i) {
+      world[x + i].set(tiles.subarray(i * h, (i + 1) * h), y);
+    }
+    off += w * h;
+  }
+};
+
 const main = async () => {
 
   const canvas = document.getElementById('game-canvas');
@@ -284,14 +488,15 @@ const main = async () => {
 
   // init key events
   window.addEventListener('keydown', event => {
-    const key = event.key.toLowerCase();
-    console.log(key)
-    keys[key] = true;
+    const bit = KEY_BITS.indexOf(event.key.toLowerCase());
+    if (bit < 0 || keys & (1 << bit)) return;
+    keys |= 1 << bit;
     keysChanged = true;
   });
   window.addEventListener('keyup', event => {
-    const key = event.key.toLowerCase();
-    keys[key] = false;
+    const bit = KEY_BITS.indexOf(event.key.toLowerCase());
+    if (bit < 0) return;
+    keys &= ~(1 << bit);
     keysChanged = true;
   });
 
@@ -390,9 +595,11 @@ const main = async () => {
 
   const render = (dt) => {
     if (keysChanged) {
-      sock.emit('update_keys', keys);
+      // at most one update per frame
+      sock.emit('input', [++inputSeq, keys]);
       keysChanged = false;
     }
+    entities = interpolate();
     if (Math.abs(playerX - camX) > halfCamW * 1.2 || Math.abs(playerY - camY) > halfCamH * 1.2) {
       // if camera gets too far then teleport it to player
       console.log('reset camera');
@@ -419,9 +626,11 @@ const main = async () => {
     let worldEndY = Math.min(world[0].length - 1, Math.floor(camY + halfCamH + 1));
     for (let i = worldStartX; i <= worldEndX; ++i) {
       for (let j = worldStartY; j <= worldEndY; ++j) {
+        const tile = world[i][j];
+        if (tile === UNKNOWN_TILE) continue;
         mat3.translate(M, VP, [i+0.5, j+0.5]); // translate model to world position
         //mat3.scale(M, M, [1., 1., 1.]); // scale model to correct size
-        drawSquare(M, sprites[world[i][j]]);
+        drawSquare(M, sprites[tile]);
       }
     }
     // render entities
@@ -430,8 +639,8 @@ const main = async () => {
       drawSquare(entity.MVP(), sprites[entity.spriteID]);
     });
 
-    healths.forEach(health => {
-        let [x, y, w, h, hp, maxHp] = health;
+    entities.forEach(({x, y, w, hp, maxHp}) => {
+        if (!maxHp) return;
 
         let M0 = mat3.create();
         mat3.translate(M0, VP, [x, y+0.5*w+0.5]); // translate model to world position
@@ -473,14 +682,25 @@ const main = async () => {
   var sock = io.connect('http://' + ip + ':6942');
 
   sock.on("connect", () => requestAnimationFrame(loop));
-  sock.on("entities", elist => {
-    entities = elist.map(tup => new Entity(...tup));
+  sock.on("entities", buf => {
+    const snapshot = applySnapshot(buf);
+    if (snapshot === null) return;
+    const [tick, state, selfID] = snapshot;
+    bufferSnapshot(tick, state, selfID);
+    sock.emit('ack', tick);
+  });
+  sock.on("clock", clock => {
+    tps = clock.tps;
+    interpDelay = clock.interp_delay;
+    tickOffset = undefined;
   });
-  sock.on("health", hlist => {
-    healths = hlist;
+  sock.on("level", level => {
+    // the chunks of the new level follow
+    console.log('level ' + level);
+    world = [[]];
   });
-  sock.on("world", world_data => {
-    world = world_data;
+  sock.on("world", buf => {
+    applyChunks(buf);
   });
 };
 